@@ -1,21 +1,50 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import base64
+import functools
+import gzip
+import hmac
 import logging
+import multiprocessing
 from datetime import datetime, date, timedelta, time
 import calendar
+import csv
 import os
+import queue
+import secrets
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from time import monotonic, perf_counter, sleep, time_ns
 import pytz # <-- إضافة جديدة للتعامل مع المناطق الزمنية
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, InvalidToken, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
+    BasePersistence,
     ContextTypes,
     ConversationHandler,
+    PersistenceInput,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
+try:
+    from openpyxl import Workbook # اختياري: مطلوب فقط لتصدير XLSX
+except ImportError:
+    Workbook = None
 import firebase_admin
 from firebase_admin import credentials, db
 
@@ -25,32 +54,50 @@ from firebase_admin import credentials, db
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
 FIREBASE_DATABASE_URL = os.getenv("FIREBASE_DATABASE_URL", "https://hr-myslide-default-rtdb.europe-west1.firebasedatabase.app")
 
+# إعداد التسجيل لرؤية الأخطاء والمشاكل
+# يتم تكوين نظام التسجيل (logging) عند التشغيل فقط، حتى يبقى استيراد الوحدة بدون آثار جانبية.
+logger = logging.getLogger(__name__)
+
+def configure_logging() -> None:
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
 # --- إعداد اتصال Firebase ---
-# محاولة الاتصال بقاعدة بيانات Firebase باستخدام بيانات الاعتماد.
+# لا يتم الاتصال عند استيراد الوحدة: التهيئة تتم عبر init_firebase() عند الإقلاع (post_init)
+# أو تلقائياً عند أول استخدام لقاعدة البيانات، مع إعادة المحاولة عند الفشل.
 # يتم البحث عن بيانات الاعتماد كمتغير بيئة JSON أو كملف محلي.
-try:
+FIREBASE_INIT_RETRIES = int(os.getenv("FIREBASE_INIT_RETRIES", "3"))
+_firebase_init_lock = threading.Lock()
+
+def _load_firebase_credentials():
     firebase_creds_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
     if firebase_creds_json:
-        print("INFO: Reading Firebase credentials from environment variable.")
-        cred_dict = json.loads(firebase_creds_json)
-        cred = credentials.Certificate(cred_dict)
-    else:
-        print("INFO: Using local 'firebase-credentials.json' file.")
-        cred = credentials.Certificate("firebase-credentials.json")
-
-    # تهيئة تطبيق Firebase إذا لم يكن مهيئًا بالفعل
-    if not firebase_admin._apps:
-        firebase_admin.initialize_app(cred, {'databaseURL': FIREBASE_DATABASE_URL})
-    print("SUCCESS: Firebase connected successfully!")
-except Exception as e:
-    # طباعة رسالة خطأ والخروج إذا فشل الاتصال بـ Firebase
-    print(f"ERROR: Could not connect to Firebase. Reason: {e}")
-    exit()
+        logger.info("Reading Firebase credentials from environment variable.")
+        return credentials.Certificate(json.loads(firebase_creds_json))
+    logger.info("Using local 'firebase-credentials.json' file.")
+    return credentials.Certificate("firebase-credentials.json")
 
-# إعداد التسجيل لرؤية الأخطاء والمشاكل
-# يتم تكوين نظام التسجيل (logging) لعرض الرسائل المعلوماتية والأخطاء.
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
-logger = logging.getLogger(__name__)
+def init_firebase() -> None:
+    """
+    تهيئة تطبيق Firebase مرة واحدة (آمنة للاستدعاء المتكرر ومن عدة خيوط).
+    ترفع آخر خطأ إذا فشلت جميع المحاولات، وتعاد المحاولة عند الاستدعاء التالي.
+    الانتظار بين المحاولات يتم خارج القفل، وتُستدعى دائماً من خيط وليس من حلقة الأحداث.
+    """
+    started = monotonic()
+    for attempt in range(1, FIREBASE_INIT_RETRIES + 1):
+        if firebase_admin._apps:
+            return
+        with _firebase_init_lock:
+            if firebase_admin._apps:
+                return
+            try:
+                firebase_admin.initialize_app(_load_firebase_credentials(), {'databaseURL': FIREBASE_DATABASE_URL})
+                logger.info(f"Firebase initialised in {(monotonic() - started) * 1000:.0f} ms (attempt {attempt})")
+                return
+            except Exception as e:
+                logger.warning(f"Firebase initialisation attempt {attempt}/{FIREBASE_INIT_RETRIES} failed: {e}")
+                if attempt == FIREBASE_INIT_RETRIES:
+                    raise
+        sleep(min(2 ** attempt, 10))
 
 # --- تعريف حالات المحادثات الموحدة ---
 # تحديد حالات المحادثة المختلفة لـ ConversationHandler.
@@ -66,16 +113,39 @@ logger = logging.getLogger(__name__)
 ) = range(14)
 
 # --- دوال إنشاء واجهات المستخدم (التقويم والأزرار) ---
+# لوحات المفاتيح في PTB غير قابلة للتعديل بعد إنشائها، لذلك يمكن مشاركتها بأمان بين المستخدمين.
+# يتم حفظ آخر لوحات التقويم المستخدمة (LRU)، وتُمسح الذاكرة عند تغيّر اليوم لأن الأيام الماضية تُعطّل.
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "512"))
+_keyboard_cache_day = None
+
+def _invalidate_keyboards_on_day_rollover() -> date:
+    """مسح ذاكرة التقويمات عند بداية يوم جديد، وإرجاع تاريخ اليوم."""
+    global _keyboard_cache_day
+    today = date.today()
+    if today != _keyboard_cache_day:
+        _build_advanced_calendar.cache_clear()
+        _build_weekly_calendar.cache_clear()
+        _keyboard_cache_day = today
+    return today
+
 def create_advanced_calendar(year: int, month: int, selection_mode: str, selected_dates: list, back_callback: str) -> InlineKeyboardMarkup:
     """
     إنشاء تقويم تفاعلي مع أزرار تنقل وزر رجوع.
     يسمح باختيار تاريخ واحد، نطاق من التواريخ، أو تواريخ متعددة.
     """
+    today = _invalidate_keyboards_on_day_rollover()
+    # مفتاح الذاكرة يحتوي فقط ما يؤثر على شكل هذا الشهر، لرفع نسبة إعادة الاستخدام
+    month_selection = tuple(sorted(d for d in selected_dates if d.year == year and d.month == month))
+    range_start = selected_dates[0] if selection_mode == 'range' and selected_dates else None
+    return _build_advanced_calendar(year, month, selection_mode, month_selection, range_start, bool(selected_dates), today, back_callback)
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def _build_advanced_calendar(year: int, month: int, selection_mode: str, month_selection: tuple, range_start,
+                             has_selection: bool, today: date, back_callback: str) -> InlineKeyboardMarkup:
     cal = calendar.Calendar()
     # أسماء الشهور باللغة العربية
     month_names_ar = ["", "يناير", "فبراير", "مارس", "أبريل", "مايو", "يونيو", "يوليو", "أغسطس", "سبتمبر", "أكتوبر", "نوفمبر", "ديسمبر"]
     month_name = month_names_ar[month]
-    today = date.today()
     keyboard = []
 
     # صف الرأس للتقويم (أزرار التنقل بين الشهور واسم الشهر والسنة)
@@ -101,10 +171,10 @@ def create_advanced_calendar(year: int, month: int, selection_mode: str, selecte
             else:
                 current_day = date(year, month, day_num)
                 # تعطيل الأيام الماضية أو الأيام التي تسبق تاريخ البدء في وضع النطاق
-                is_disabled = current_day < today or (selection_mode == 'range' and selected_dates and current_day < selected_dates[0])
+                is_disabled = current_day < today or (range_start is not None and current_day < range_start)
                 day_text = str(day_num)
                 # تمييز الأيام المختارة
-                if current_day in selected_dates:
+                if current_day in month_selection:
                     day_text = f"*{day_num}*"
 
                 if is_disabled:
@@ -114,7 +184,7 @@ def create_advanced_calendar(year: int, month: int, selection_mode: str, selecte
         keyboard.append(row)
 
     # زر "تم الاختيار" لوضع الاختيار المتعدد
-    if selection_mode == 'multiple' and selected_dates:
+    if selection_mode == 'multiple' and has_selection:
         keyboard.append([InlineKeyboardButton("✅ تم الاختيار", callback_data="CAL_DONE")])
 
     # أزرار الرجوع والقائمة الرئيسية
@@ -127,6 +197,11 @@ def create_weekly_calendar(start_date: date, back_callback: str) -> InlineKeyboa
     إنشاء تقويم لمدة أسبوع واحد بدءًا من تاريخ محدد.
     يتم تعطيل الأيام الماضية.
     """
+    today = _invalidate_keyboards_on_day_rollover()
+    return _build_weekly_calendar(start_date, today, back_callback)
+
+@functools.lru_cache(maxsize=64)
+def _build_weekly_calendar(start_date: date, today: date, back_callback: str) -> InlineKeyboardMarkup:
     keyboard = []
     # أسماء الأيام باللغة العربية
     days_ar = ["إثنين", "ثلاثاء", "أربعاء", "خميس", "جمعة", "سبت", "أحد"]
@@ -140,7 +215,7 @@ def create_weekly_calendar(start_date: date, back_callback: str) -> InlineKeyboa
         callback_data = f"HL_DATE_{current_day.isoformat()}"
         
         # تعطيل الأيام الماضية
-        if current_day < date.today():
+        if current_day < today:
             if len(row1) < 4:
                 row1.append(InlineKeyboardButton(" ", callback_data="CAL_IGNORE"))
             else:
@@ -161,10 +236,12 @@ def create_weekly_calendar(start_date: date, back_callback: str) -> InlineKeyboa
     return InlineKeyboardMarkup(keyboard)
 
 
+@functools.lru_cache(maxsize=None)
 def create_time_keyboard(leave_type: str, back_callback: str) -> InlineKeyboardMarkup:
     """
     إنشاء لوحة مفاتيح لاختيار الوقت مع زر رجوع.
     تختلف خيارات الوقت بناءً على نوع الإذن (تأخير صباحي أو مغادرة مبكرة).
+    اللوحة ثابتة، لذلك يتم بناؤها مرة واحدة فقط لكل (نوع، زر رجوع).
     """
     keyboard = []
     if leave_type == 'late':
@@ -188,43 +265,1198 @@ def create_time_keyboard(leave_type: str, back_callback: str) -> InlineKeyboardM
     keyboard.append([InlineKeyboardButton("➡️ رجوع", callback_data=back_callback), InlineKeyboardButton("القائمة الرئيسية ↩️", callback_data="main_menu")])
     return InlineKeyboardMarkup(keyboard)
 
+# بناء لوحات الوقت المستخدمة في مسار الإذن الساعي مسبقاً عند الإقلاع
+for _leave_type in ('late', 'early'):
+    create_time_keyboard(_leave_type, "hl_back_to_date_selection")
+
+# --- المقاييس وقياس زمن المعالجات (بصيغة Prometheus) ---
+# METRICS_MODE: off (افتراضي) أو http (نقطة /metrics) أو log (ملخص دوري في السجلات).
+# القياس يتم دائماً لأنه رخيص، والوضع يحدد فقط طريقة عرضه.
+METRICS_MODE = os.getenv("METRICS_MODE", "off")
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "256"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "60"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """عدادات ومدرجات تكرارية (histograms) بسيطة، آمنة للاستخدام من عدة خيوط."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def set_gauge(self, name: str, labels: tuple = (), value: float = 0) -> None:
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name: str, labels: tuple, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                # [عدد كل فئة..., المجموع, العدد, الأقصى]
+                histogram = self._histograms[(name, labels)] = [0] * len(self._buckets) + [0.0, 0, 0.0]
+            for i, bound in enumerate(self._buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            n = len(self._buckets)
+            histogram[n] += seconds
+            histogram[n + 1] += 1
+            histogram[n + 2] = max(histogram[n + 2], seconds)
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = [f'{key}="{value}"' for key, value in labels + extra]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> str:
+        """تصدير جميع المقاييس بصيغة Prometheus النصية."""
+        lines = []
+        with self._lock:
+            for kind, values in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (metric, labels), value in sorted(values.items()):
+                        if metric == name:
+                            lines.append(f"{name}{self._format_labels(labels)} {value}")
+            n = len(self._buckets)
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in zip(self._buckets, histogram):
+                        lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {histogram[n + 1]}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[n]}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {histogram[n + 1]}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """ملخص مختصر للسجلات: العدد والمتوسط والأقصى لكل مدرج، وقيم العدادات."""
+        parts = []
+        with self._lock:
+            n = len(self._buckets)
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                count = histogram[n + 1]
+                label = ",".join(str(value) for _, value in labels)
+                parts.append(f"{name}[{label}] n={count} avg={histogram[n] / count * 1000:.1f}ms max={histogram[n + 2] * 1000:.1f}ms")
+            for (name, labels), value in sorted({**self._counters, **self._gauges}.items()):
+                label = ",".join(str(value) for _, value in labels)
+                parts.append(f"{name}[{label}]={value:g}")
+        return "; ".join(parts)
+
+metrics = Metrics()
+
+def instrument(callback, name: str = None):
+    """تغليف معالج أو مهمة مجدولة لقياس زمن التنفيذ وعدد الأخطاء."""
+    labels = (("handler", name or callback.__name__),)
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            metrics.inc("hr_bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("hr_bot_handler_latency_seconds", labels, perf_counter() - started)
+    return wrapper
+
+def instrument_application(application: Application) -> None:
+    """تغليف جميع المعالجات المسجلة، بما فيها نقاط الدخول وحالات ConversationHandler."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            nested = [handler]
+            if isinstance(handler, ConversationHandler):
+                nested = list(handler.entry_points) + list(handler.fallbacks)
+                nested += [h for state_handlers in handler.states.values() for h in state_handlers]
+            for inner in nested:
+                inner.callback = instrument(inner.callback)
+
+class InstrumentedRequest(HTTPXRequest):
+    """طبقة طلبات تيليجرام تحصي استدعاءات Bot API وزمنها حسب اسم الدالة."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        started = perf_counter()
+        try:
+            return await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            metrics.inc("hr_bot_telegram_errors_total", labels)
+            raise
+        finally:
+            metrics.inc("hr_bot_telegram_calls_total", labels)
+            metrics.observe("hr_bot_telegram_latency_seconds", labels, perf_counter() - started)
+
+async def log_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """مهمة دورية لوضع log: كتابة ملخص المقاييس في السجلات."""
+    logger.info(f"Metrics: {metrics.summary()}")
+
+async def serve_metrics(headers: dict, body: bytes):
+    return 200, "text/plain; version=0.0.4", metrics.render().encode()
+
+# --- طبقة الوصول غير الحاجبة إلى Firebase ---
+# عمليات firebase_admin حاجبة (طلبات HTTP متزامنة)، لذلك يتم تنفيذها على مجموعة
+# خيوط محدودة الحجم بدلاً من حلقة الأحداث، ولا تقوم المعالجات إلا بانتظارها (await).
+FIREBASE_MAX_WORKERS = int(os.getenv("FIREBASE_MAX_WORKERS", "8"))
+
+class FirebaseRepository:
+    """غلاف غير حاجب لجميع عمليات القراءة والكتابة على Firebase."""
+
+    def __init__(self, max_workers: int = FIREBASE_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firebase")
+
+    async def run(self, fn, *args, op: str = "call", **kwargs):
+        """تنفيذ أي دالة حاجبة على مجموعة خيوط Firebase، مع قياس العدد والزمن (بما فيه الانتظار في الطابور)."""
+        loop = asyncio.get_running_loop()
+        labels = (("op", op),)
+        started = perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(self._call, fn, *args, **kwargs))
+        except Exception:
+            metrics.inc("hr_bot_firebase_errors_total", labels)
+            raise
+        finally:
+            metrics.inc("hr_bot_firebase_calls_total", labels)
+            metrics.observe("hr_bot_firebase_latency_seconds", labels, perf_counter() - started)
+
+    @staticmethod
+    def _call(fn, *args, **kwargs):
+        init_firebase()
+        return fn(*args, **kwargs)
+
+    async def get(self, path: str):
+        return await self.run(lambda: db.reference(path).get(), op="get")
+
+    async def update(self, path: str, value: dict) -> None:
+        await self.run(lambda: db.reference(path).update(value), op="update")
+
+    async def transaction(self, path: str, transaction_update):
+        return await self.run(lambda: db.reference(path).transaction(transaction_update), op="transaction")
+
+    async def query(self, path: str, order_by: str = None, equal_to=None, start_at=None, end_at=None,
+                    limit_to_first: int = None, limit_to_last: int = None) -> dict:
+        """
+        استعلام مفهرس. order_by يكون اسم حقل، أو '$key' للترتيب حسب المفتاح.
+        """
+        def _query():
+            ref = db.reference(path)
+            query = ref.order_by_key() if order_by == '$key' else ref.order_by_child(order_by)
+            if equal_to is not None:
+                query = query.equal_to(equal_to)
+            if start_at is not None:
+                query = query.start_at(start_at)
+            if end_at is not None:
+                query = query.end_at(end_at)
+            if limit_to_first is not None:
+                query = query.limit_to_first(limit_to_first)
+            if limit_to_last is not None:
+                query = query.limit_to_last(limit_to_last)
+            return query.get() or {}
+        return await self.run(_query, op="query")
+
+    async def scan(self, path: str, page_size: int = 500, start_at: str = None, end_at: str = None):
+        """
+        قراءة مجموعة كبيرة صفحةً صفحة مرتبة حسب المفتاح (مولّد غير متزامن يعيد قائمة (مفتاح، قيمة) لكل صفحة).
+        يتم جلب عنصر إضافي في كل صفحة ليكون مؤشر الصفحة التالية.
+        """
+        cursor = start_at
+        while True:
+            page = await self.query(path, order_by='$key', start_at=cursor, end_at=end_at,
+                                    limit_to_first=page_size + 1)
+            items = list(page.items())
+            if items[:page_size]:
+                yield items[:page_size]
+            if len(items) <= page_size:
+                return
+            cursor = items[page_size][0]
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+repo = FirebaseRepository()
+
 # --- دوال مساعدة (قاعدة البيانات) ---
+# مدة صلاحية النسخة المحلية من /users بالثواني، ووضع التحديث (ttl أو listen)
+USERS_CACHE_TTL = int(os.getenv("USERS_CACHE_TTL", "300"))
+USERS_CACHE_MODE = os.getenv("USERS_CACHE_MODE", "ttl")
+USERS_INITIAL_LOAD_TIMEOUT = 10 # انتظار الحدث الأول من المستمع عند الإقلاع
+
+def _apply_firebase_event(tree: dict, event_type: str, path: str, data) -> dict:
+    """
+    تطبيق حدث من أحداث المستمع (put أو patch) على نسخة محلية من الشجرة.
+    يعيد الشجرة بعد التعديل (قد تكون كائناً جديداً إذا تم استبدال الجذر).
+    """
+    keys = [k for k in path.split('/') if k]
+    if not keys:
+        if event_type == 'put':
+            return data if isinstance(data, dict) else {}
+        tree = tree if isinstance(tree, dict) else {}
+        for key, value in (data or {}).items():
+            if value is None:
+                tree.pop(key, None)
+            else:
+                tree[key] = value
+        return tree
+
+    tree = tree if isinstance(tree, dict) else {}
+    node = tree
+    for key in keys[:-1]:
+        child = node.get(key)
+        if not isinstance(child, dict):
+            child = {}
+            node[key] = child
+        node = child
+    last = keys[-1]
+    if event_type == 'put':
+        if data is None:
+            node.pop(last, None)
+        else:
+            node[last] = data
+    else:  # patch
+        child = node.get(last)
+        if not isinstance(child, dict):
+            child = {}
+            node[last] = child
+        for key, value in (data or {}).items():
+            if value is None:
+                child.pop(key, None)
+            else:
+                child[key] = value
+    return tree
+
+class UserDirectory:
+    """
+    نسخة محلية من شجرة /users مع فهارس حسب telegram_id والدور.
+    يتم تحميل الشجرة عند الإقلاع (post_init)، ثم تُحدّث في الخلفية عند انتهاء صلاحيتها (ttl)
+    أو فوراً عبر مستمع Firebase (listen). المعالجات لا تنتظر Firebase أبداً: تقرأ آخر نسخة محملة.
+    """
+
+    def __init__(self, ttl: int = USERS_CACHE_TTL, mode: str = USERS_CACHE_MODE):
+        self.ttl = ttl
+        self.mode = mode
+        self._raw = {}
+        self._by_id = {}
+        self._by_role = {}
+        self._loaded_at = None
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._listener = None
+
+    def _rebuild(self) -> None:
+        """إعادة بناء الفهارس من النسخة الخام."""
+        by_id, by_role = {}, {}
+        for user_data in self._raw.values():
+            if not isinstance(user_data, dict):
+                continue
+            telegram_id = str(user_data.get("telegram_id", ""))
+            if telegram_id:
+                by_id[telegram_id] = user_data
+            role = user_data.get("role")
+            if role:
+                by_role.setdefault(role, []).append(user_data)
+        # استبدال الفهارس دفعة واحدة حتى لا يرى القارئ حالة نصف محدثة
+        self._by_id, self._by_role = by_id, by_role
+        self._loaded_at = monotonic()
+        self._loaded.set()
+
+    def refresh(self) -> None:
+        """تنزيل شجرة /users كاملة وإعادة بناء الفهارس (عملية حاجبة)."""
+        started = perf_counter()
+        try:
+            init_firebase()
+            users = db.reference('/users').get() or {}
+            metrics.observe("hr_bot_firebase_latency_seconds", (("op", "users_refresh"),), perf_counter() - started)
+            metrics.inc("hr_bot_firebase_calls_total", (("op", "users_refresh"),))
+            with self._lock:
+                self._raw = users if isinstance(users, dict) else {}
+                self._rebuild()
+        except Exception as e:
+            logger.error(f"Error refreshing user directory: {e}")
+        finally:
+            self._refreshing = False
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="user-directory-refresh", daemon=True).start()
+
+    def _on_event(self, event) -> None:
+        """تطبيق تغييرات المستمع على النسخة المحلية."""
+        try:
+            with self._lock:
+                self._raw = _apply_firebase_event(self._raw, event.event_type, event.path, event.data)
+                self._rebuild()
+        except Exception as e:
+            logger.error(f"Error applying user directory event: {e}")
+
+    def start(self) -> None:
+        """التحميل الأولي (حاجب، يُستدعى من خيط عند الإقلاع) وتشغيل المستمع إذا كان الوضع listen."""
+        if self.mode == 'listen' and self._listener is None:
+            try:
+                init_firebase()
+                # الحدث الأول من المستمع يحمل الشجرة كاملة، فلا حاجة لتحميل منفصل
+                self._listener = db.reference('/users').listen(self._on_event)
+                if not self._loaded.wait(USERS_INITIAL_LOAD_TIMEOUT):
+                    logger.warning("Users listener has not delivered the initial snapshot yet")
+                return
+            except Exception as e:
+                logger.error(f"Could not start users listener, falling back to TTL: {e}")
+                self.mode = 'ttl'
+        self.refresh()
+
+    def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _ensure_fresh(self) -> None:
+        if self.mode == 'listen':
+            return
+        if self._loaded_at is None or monotonic() - self._loaded_at > self.ttl:
+            # لم يكتمل التحميل الأولي أو البيانات قديمة: نخدم النسخة الحالية (أو لا شيء) ونحدّث في الخلفية
+            self._refresh_in_background()
+
+    def get_user(self, telegram_id: str):
+        self._ensure_fresh()
+        return self._by_id.get(str(telegram_id))
+
+    def get_by_role(self, role: str) -> list:
+        self._ensure_fresh()
+        return self._by_role.get(role, [])
+
+user_directory = UserDirectory()
+
 def get_predefined_user(telegram_id: str):
-    """جلب بيانات المستخدم المعرف مسبقاً من Firebase بناءً على Telegram ID."""
-    try:
-        ref = db.reference('/users')
-        users = ref.get() or {}
-        for user_data in users.values():
-            if user_data and str(user_data.get("telegram_id", "")) == telegram_id:
-                return user_data
-    except Exception as e:
-        logger.error(f"Error fetching predefined user: {e}")
-    return None
+    """جلب بيانات المستخدم المعرف مسبقاً من دليل المستخدمين بناءً على Telegram ID."""
+    return user_directory.get_user(telegram_id)
 
 def get_all_team_leaders_ids():
-    """جلب جميع معرفات Telegram لقادة الفرق من Firebase."""
-    leader_ids = []
-    try:
-        ref = db.reference('/users')
-        users = ref.get() or {}
-        for user_data in users.values():
-            if user_data and user_data.get("role") == "team_leader":
-                leader_ids.append(user_data.get("telegram_id"))
-    except Exception as e:
-        logger.error(f"Error fetching team leaders: {e}")
-    return leader_ids
+    """جلب جميع معرفات Telegram لقادة الفرق من دليل المستخدمين."""
+    return [user_data.get("telegram_id") for user_data in user_directory.get_by_role("team_leader")]
 
 def get_hr_telegram_id():
-    """جلب معرف Telegram لمدير الموارد البشرية من Firebase."""
+    """جلب معرف Telegram لمدير الموارد البشرية من دليل المستخدمين."""
+    hr_users = user_directory.get_by_role("hr")
+    return hr_users[0].get("telegram_id") if hr_users else None
+
+# --- حقول الفهرسة للتواريخ والحالة ---
+# تواريخ الطلب تُحفظ بشكل مضغوط في الحقل period: {"start", "end"} لأيام متتالية أو {"days": [...]} لأيام متفرقة،
+# والنص المعروض يُشتق منه. يُحفظ أيضاً تاريخ البدء والانتهاء بصيغة ISO قابلة للترتيب، وحقل مركب
+# (الحالة + تاريخ البدء) يسمح باستعلام مفهرس واحد مثل: approved_2024-08-01.
+# يجب إضافة ".indexOn": ["status_start", "start_date"] لكل من المسارين في قواعد Firebase.
+
+def expand_selected_dates(duration_type: str, selected_dates: list) -> list:
+    """تحويل التواريخ المختارة من التقويم إلى قائمة كاملة مرتبة (النطاق يتم توسيعه يوماً بيوم)."""
+    selected_dates = sorted(selected_dates)
+    if duration_type == 'range' and len(selected_dates) >= 2:
+        days = (selected_dates[-1] - selected_dates[0]).days
+        return [selected_dates[0] + timedelta(days=i) for i in range(days + 1)]
+    return selected_dates
+
+def date_period(dates: list) -> dict:
+    """التمثيل المضغوط لقائمة تواريخ: نطاق للأيام المتتالية (واليوم الواحد)، أو قائمة مرتبة للأيام المتفرقة."""
+    dates = sorted(set(dates))
+    if (dates[-1] - dates[0]).days == len(dates) - 1:
+        return {"start": dates[0].isoformat(), "end": dates[-1].isoformat()}
+    return {"days": [d.isoformat() for d in dates]}
+
+def period_dates(period: dict) -> list:
+    """كل أيام الفترة كقائمة مرتبة من كائنات date."""
+    if "days" in period:
+        return [date.fromisoformat(d) for d in period["days"]]
+    return expand_selected_dates('range', [date.fromisoformat(period["start"]), date.fromisoformat(period["end"])])
+
+def format_period(period: dict) -> str:
+    """النص المعروض للفترة: يوم واحد، "من ... إلى ..."، أو أيام مفصولة بفواصل."""
+    if "days" in period:
+        return ", ".join(date.fromisoformat(d).strftime('%d/%m/%Y') for d in period["days"])
+    start = date.fromisoformat(period["start"]).strftime('%d/%m/%Y')
+    if period["start"] == period["end"]:
+        return start
+    return f"من {start} إلى {date.fromisoformat(period['end']).strftime('%d/%m/%Y')}"
+
+def leave_index_fields(status: str, dates: list) -> dict:
+    """بناء حقل الفترة وحقول الفهرسة لسجل إجازة من قائمة تواريخ (كائنات date)."""
+    period = date_period(dates)
+    start_date = period["days"][0] if "days" in period else period["start"]
+    return {
+        "period": period,
+        "start_date": start_date,
+        "end_date": period["days"][-1] if "days" in period else period["end"],
+        "status_start": f"{status}_{start_date}",
+    }
+
+def status_update_fields(leave_request: dict, status: str) -> dict:
+    """الحقول التي يجب تحديثها عند تغيير حالة الطلب، مع إبقاء الحقل المركب متوافقاً."""
+    fields = {"status": status}
+    if leave_request.get("start_date"):
+        fields["status_start"] = f"{status}_{leave_request['start_date']}"
+    return fields
+
+class LeaveTransitionAborted(Exception):
+    """يُرفع داخل معاملة تغيير الحالة لإلغائها دون كتابة. status تكون None إذا لم يوجد الطلب."""
+
+    def __init__(self, status):
+        super().__init__(f"Leave transition aborted (current status: {status})")
+        self.status = status
+
+def pending_status_transition(new_status: str, effects=None):
+    """
+    دالة تحديث لمعاملة Firebase تنقل الطلب من pending إلى new_status.
+    المعاملة تقرأ السجل مع ETag ثم تكتب بشرط عدم تغيّره، وتعيد السجل الجديد.
+    effects(السجل الجديد) تعيد آثار القرار (الفهارس والعدادات والإشعارات)، فتُحفظ داخل السجل في نفس الكتابة
+    ولا تضيع إذا توقفت العملية قبل تطبيقها (انظر apply_decision_effects).
+    decided_at (حقل مفهرس) يسمح للعمال الآخرين بقراءة القرارات الجديدة فقط (انظر sync_decisions).
+    """
+    def _update(current):
+        if not current:
+            raise LeaveTransitionAborted(None)
+        if current.get("status") != "pending":
+            raise LeaveTransitionAborted(current.get("status"))
+        updated = {**current, **status_update_fields(current, new_status), "decided_at": now_ms()}
+        if effects is not None:
+            updated["pending_effects"] = json.dumps(effects(updated), ensure_ascii=False)
+            updated["effects_at"] = now_ms()
+        return updated
+    return _update
+
+def leave_dates(leave_type_key: str, leave_request: dict) -> list:
+    """قائمة تواريخ الطلب (كائنات date) من حقل الفترة، أو من الحقول القديمة للسجلات السابقة."""
+    if leave_request.get("period"):
+        return period_dates(leave_request["period"])
+    if leave_request.get("dates"):
+        return [date.fromisoformat(d) for d in leave_request["dates"]]
+    return parse_date_info(leave_request.get("date_info" if leave_type_key == 'fd' else "date", ""))
+
+def parse_date_info(date_info: str) -> list:
+    """
+    تحليل نص تاريخ الإجازة القديم (السجلات السابقة) إلى قائمة تواريخ.
+    يعالج الحالات: يوم واحد، نطاق، أيام متعددة.
+    """
     try:
-        ref = db.reference('/users')
-        users = ref.get() or {}
-        for user_data in users.values():
-            if user_data and user_data.get("role") == "hr":
-                return user_data.get("telegram_id")
-    except Exception as e:
-        logger.error(f"Error fetching HR ID: {e}")
-    return None
+        # الحالة: "من 01/08/2024 إلى 05/08/2024"
+        if "من" in date_info:
+            parts = date_info.split(" ")
+            start = datetime.strptime(parts[1], "%d/%m/%Y").date()
+            end = datetime.strptime(parts[3], "%d/%m/%Y").date()
+            return expand_selected_dates('range', [start, end])
+        # الحالة: "01/08/2024, 03/08/2024"
+        elif "," in date_info:
+            return sorted(datetime.strptime(part.strip(), "%d/%m/%Y").date() for part in date_info.split(","))
+        # الحالة: "01/08/2024"
+        else:
+            return [datetime.strptime(date_info, "%d/%m/%Y").date()]
+    except (ValueError, IndexError) as e:
+        logger.error(f"Could not parse date from string '{date_info}': {e}")
+        return []
+
+def migrate_leave_indexes() -> None:
+    """
+    أمر لمرة واحدة: إضافة حقل الفترة وحقول الفهرسة للسجلات القديمة التي لا تحتويها.
+    الاستخدام: python HR_MYSLIDE.py migrate
+    """
+    init_firebase()
+    for leave_type_key, collection in LEAVE_COLLECTIONS.items():
+        leaves = db.reference(f'/{collection}').get() or {}
+        updates = {}
+        backfilled = skipped = 0
+        for leave_id, leave_data in leaves.items():
+            if not isinstance(leave_data, dict) or leave_data.get("period"):
+                continue
+            dates = leave_dates(leave_type_key, leave_data)
+            if not dates:
+                skipped += 1
+                continue
+            for field, value in leave_index_fields(leave_data.get("status", "pending"), dates).items():
+                updates[f"{leave_id}/{field}"] = value
+            # قائمة التواريخ الموسعة استُبدلت بحقل الفترة المضغوط
+            updates[f"{leave_id}/dates"] = None
+            backfilled += 1
+        _update_in_batches(f'/{collection}', updates)
+        print(f"INFO: {collection}: backfilled {backfilled} records, skipped {skipped} unparseable records.")
+    rebuild_employee_indexes()
+
+def _update_in_batches(path: str, updates: dict, batch_size: int = 500) -> None:
+    """كتابة التحديثات على دفعات في طلبات متعددة المسارات."""
+    items = list(updates.items())
+    for i in range(0, len(items), batch_size):
+        db.reference(path).update(dict(items[i:i + batch_size]))
+
+def rebuild_employee_indexes() -> None:
+    """
+    جزء من أمر migrate: بناء فهرس طلبات كل موظف وطابور الموافقات وعدادات الرصيد السنوية
+    من السجلات الحالية، للطلبات التي أنشئت قبل وجود هذه الفهارس.
+    """
+    updates = {}
+    counters = {}
+    for leave_type_key, collection in LEAVE_COLLECTIONS.items():
+        leaves = db.reference(f'/{collection}').get() or {}
+        for leave_id, leave_data in leaves.items():
+            if not isinstance(leave_data, dict) or not leave_data.get("employee_telegram_id"):
+                continue
+            leave_data.setdefault("employee_name", "موظف")
+            leave_data.setdefault("request_time", "")
+            status = leave_data.setdefault("status", "pending")
+            index_updates = leave_creation_updates(leave_type_key, leave_id, leave_data)
+            del index_updates[f"{collection}/{leave_id}"]
+            if status != "pending":
+                del index_updates[f"pending_approvals/{leave_id}"]
+            updates.update(index_updates)
+            if status in ("approved", "rejected"):
+                for path, amount in leave_counter_increments(leave_type_key, leave_data, status).items():
+                    counters[path] = counters.get(path, 0) + amount
+    # العدادات تُكتب كقيم مطلقة لأنها محسوبة من كامل السجل
+    updates.update(counters)
+    _update_in_batches('/', updates)
+    print(f"INFO: rebuilt {len(updates) - len(counters)} index entries and {len(counters)} counters.")
+
+# --- إنشاء الطلبات بكتابة واحدة متعددة المسارات ---
+# يتم توليد مفتاح الطلب محلياً، ثم كتابة السجل وفهرس الموظف وطابور الموافقات في تحديث ذري واحد.
+LEAVE_COLLECTIONS = {"fd": "full_day_leaves", "hourly": "hourly_leaves"}
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+_push_id_lock = threading.Lock()
+_last_push_ms = 0
+_last_push_random = [0] * 12
+
+def generate_push_id() -> str:
+    """
+    توليد مفتاح بنفس خوارزمية push() في Firebase دون طلب شبكة:
+    8 رموز من الوقت بالمللي ثانية ثم 12 رمزاً عشوائياً، فتبقى المفاتيح مرتبة زمنياً.
+    """
+    global _last_push_ms, _last_push_random
+    with _push_id_lock:
+        now = time_ns() // 1_000_000
+        if now == _last_push_ms:
+            # نفس المللي ثانية: زيادة الجزء العشوائي بمقدار واحد للحفاظ على الترتيب
+            for i in range(11, -1, -1):
+                if _last_push_random[i] != 63:
+                    _last_push_random[i] += 1
+                    break
+                _last_push_random[i] = 0
+        else:
+            _last_push_ms = now
+            _last_push_random = [secrets.randbelow(64) for _ in range(12)]
+        return push_id_prefix(now) + "".join(PUSH_CHARS[i] for i in _last_push_random)
+
+def push_id_prefix(timestamp_ms: int) -> str:
+    """الجزء الزمني (8 رموز) من مفتاح push؛ يصلح كحد لاستعلامات النطاق الزمني على المفاتيح."""
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(PUSH_CHARS[timestamp_ms % 64])
+        timestamp_ms //= 64
+    return "".join(reversed(time_chars))
+
+def leave_details_text(leave_type_key: str, leave_request: dict) -> str:
+    """نص التاريخ/الوقت المعروض للطلب في الإشعارات والقوائم."""
+    if leave_type_key == 'fd':
+        if leave_request.get('period'):
+            return format_period(leave_request['period'])
+        return leave_request.get('date_info', 'غير محدد')
+    leave_date = leave_request.get('date', 'بتاريخ اليوم')
+    time_details = leave_request.get('time_info', 'وقت غير محدد')
+    return f"{time_details} بتاريخ {leave_date}"
+
+def leave_creation_updates(leave_type_key: str, request_id: str, record: dict) -> dict:
+    """المسارات التي تُكتب معاً عند إنشاء طلب: السجل، فهرس الموظف، وطابور الموافقات."""
+    employee_id = record["employee_telegram_id"]
+    return {
+        f"{LEAVE_COLLECTIONS[leave_type_key]}/{request_id}": record,
+        f"employee_leaves/{employee_id}/{request_id}": {
+            "type": leave_type_key,
+            "status": record["status"],
+            "start_date": record.get("start_date"),
+            "details": leave_details_text(leave_type_key, record),
+            "request_time": record["request_time"],
+        },
+        f"pending_approvals/{request_id}": {
+            "type": leave_type_key,
+            "employee_name": record["employee_name"],
+            "employee_telegram_id": employee_id,
+            "start_date": record.get("start_date"),
+            "details": leave_details_text(leave_type_key, record),
+            "request_time": record["request_time"],
+        },
+    }
+
+def leave_status_index_updates(request_id: str, leave_request: dict, status: str) -> dict:
+    """تحديث الفهارس عند الموافقة أو الرفض: إزالة الطلب من الطابور وتحديث حالته في فهرس الموظف."""
+    return {
+        f"pending_approvals/{request_id}": None,
+        f"employee_leaves/{leave_request['employee_telegram_id']}/{request_id}/status": status,
+    }
+
+def leave_counter_increments(leave_type_key: str, leave_request: dict, status: str) -> dict:
+    """
+    مقدار الزيادة في عدادات الموظف السنوية (/leave_counters/{id}/{year}) عند الموافقة أو الرفض.
+    أيام الإجازة اليومية تُحسب لكل سنة على حدة إذا امتدت الإجازة بين سنتين.
+    """
+    counters_path = f"leave_counters/{leave_request['employee_telegram_id']}"
+    dates = leave_dates(leave_type_key, leave_request)
+    if not dates:
+        return {}
+    increments = {}
+    if status == "approved" and leave_type_key == 'fd':
+        for d in dates:
+            path = f"{counters_path}/{d.year}/approved_days"
+            increments[path] = increments.get(path, 0) + 1
+    elif status == "approved":
+        increments[f"{counters_path}/{dates[0].year}/approved_hourly"] = 1
+    else:
+        increments[f"{counters_path}/{dates[0].year}/rejected"] = 1
+    return increments
+
+async def create_leave_request(leave_type_key: str, record: dict, request_id: str = None,
+                               notifications: dict = None) -> bool:
+    """
+    إنشاء طلب جديد مع إشعاراته في صندوق الصادر في طلب شبكة واحد.
+    يعيد False إذا تعذر الوصول إلى Firebase وحُفظ الطلب في الطابور المحلي لإرساله لاحقاً.
+    """
+    request_id = request_id or generate_push_id()
+    replica.note_write(leave_type_key, request_id)
+    return await journal.submit(request_id, leave_type_key, {
+        **leave_creation_updates(leave_type_key, request_id, record),
+        **outbox_updates(notifications or {})})
+
+# --- محرك إرسال الإشعارات المتزامن ---
+# حدود تيليجرام: نحو 30 رسالة في الثانية للبوت كاملاً، ورسالة واحدة في الثانية لكل محادثة.
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_PER_CHAT_INTERVAL = float(os.getenv("NOTIFY_PER_CHAT_INTERVAL", "1.0"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "3"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """مدة الانتظار المطلوبة من تيليجرام (رقم أو timedelta حسب إصدار المكتبة)."""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+def split_message(lines: list, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    تجميع الأسطر في أقل عدد من الرسائل دون تجاوز حد طول رسالة تيليجرام.
+    التقسيم يتم عند حدود الأسطر فقط، ويُقطع السطر نفسه إذا تجاوز الحد وحده.
+    """
+    chunks, current = [], ""
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+class NotificationDispatcher:
+    """
+    يرسل الرسائل إلى عدة مستلمين بشكل متزامن مع احترام حدود تيليجرام العامة ولكل محادثة.
+    يعيد المحاولة عند RetryAfter وأخطاء الشبكة، ويعيد نتيجة كل مستلم (None عند النجاح أو الخطأ).
+    """
+
+    def __init__(self, rate: float = NOTIFY_GLOBAL_RATE, per_chat_interval: float = NOTIFY_PER_CHAT_INTERVAL,
+                 max_retries: int = NOTIFY_MAX_RETRIES):
+        self._interval = 1.0 / rate
+        self._per_chat_interval = per_chat_interval
+        self._max_retries = max_retries
+        self._next_slot = 0.0
+        self._chat_next_slot = {}
+        self._paused_until = 0.0
+
+    async def _wait_for_slot(self, chat_id) -> None:
+        # حجز موعد الإرسال يتم دون أي انتظار بين القراءة والكتابة، لذلك لا حاجة لأقفال
+        now = monotonic()
+        chat_slot = max(now, self._paused_until, self._chat_next_slot.get(chat_id, 0.0))
+        slot = max(chat_slot, self._next_slot)
+        self._next_slot = slot + self._interval
+        self._chat_next_slot[chat_id] = slot + self._per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send(self, bot, chat_id, text: str, **kwargs):
+        """إرسال رسالة واحدة مع إعادة المحاولة. يعيد None عند النجاح أو الخطأ الأخير."""
+        chat_id = str(chat_id)
+        for attempt in range(self._max_retries + 1):
+            await self._wait_for_slot(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return None
+            except RetryAfter as e:
+                # تجاوز الحد: إيقاف جميع الإرسالات مؤقتاً للمدة التي يطلبها تيليجرام
+                delay = _retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, monotonic() + delay)
+                error = e
+            except (BadRequest, Forbidden) as e:
+                # أخطاء دائمة (مستخدم حظر البوت أو معرف غير صحيح): لا فائدة من إعادة المحاولة
+                return e
+            except NetworkError as e:
+                await asyncio.sleep(min(2 ** attempt, 30))
+                error = e
+            except Exception as e:
+                return e
+        return error
+
+    async def send_many(self, bot, messages: list) -> dict:
+        """
+        إرسال قائمة من الرسائل بشكل متزامن. كل عنصر هو (chat_id, text, kwargs).
+        يعيد قاموساً {(chat_id, index): None أو الخطأ}.
+        """
+        results = await asyncio.gather(*(self.send(bot, chat_id, text, **kwargs) for chat_id, text, kwargs in messages))
+        report = {}
+        for index, ((chat_id, _, _), error) in enumerate(zip(messages, results)):
+            report[(str(chat_id), index)] = error
+            if error is not None:
+                logger.error(f"Failed to send notification to {chat_id}: {error}")
+        return report
+
+dispatcher = NotificationDispatcher()
+
+# --- صندوق الصادر الدائم للإشعارات ---
+# كل إشعار يُكتب في /outbox ضمن نفس التحديث الذي يحفظ البيانات، ثم يرسله عامل في الخلفية.
+# مفتاح كل إشعار ثابت (معرف الطلب + نوع الإشعار + المستلم) فلا تتكرر الرسالة عند إعادة الكتابة.
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BASE_DELAY = float(os.getenv("OUTBOX_BASE_DELAY", "5"))
+OUTBOX_MAX_DELAY = float(os.getenv("OUTBOX_MAX_DELAY", "3600"))
+OUTBOX_ACK_DELAY = float(os.getenv("OUTBOX_ACK_DELAY", "0.2"))
+# مهلة حجز الإشعار: من يرسله (المعالج مباشرة أو عامل التفريغ) يملكه خلالها، ولا يختاره التفريغ قبل انقضائها
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+OUTBOX_SENT_CACHE_SIZE = 10000
+
+def now_ms() -> int:
+    """الوقت الحالي بالمللي ثانية منذ 1970 (صيغة الحقول الزمنية في صندوق الصادر)."""
+    return time_ns() // 1_000_000
+
+def outbox_holder() -> str:
+    """معرف هذه العملية كمالكة لحجز الإشعارات (نفس صيغة عقد القيادة)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def outbox_entry(chat_id, text: str, parse_mode: str = None, reply_markup: InlineKeyboardMarkup = None) -> dict:
+    """
+    سجل إشعار جاهز للكتابة في /outbox. يُكتب محجوزاً لهذه العملية لمدة OUTBOX_LEASE للإرسال الفوري عبر kick_outbox،
+    فإذا توقفت العملية قبل إرساله يلتقطه التفريغ الدوري بعد انقضاء المهلة.
+    """
+    created = now_ms()
+    entry = {"chat_id": str(chat_id), "text": text, "attempts": 0, "leased_by": outbox_holder(),
+             "next_attempt": created + int(OUTBOX_LEASE * 1000), "created_at": created}
+    if parse_mode:
+        entry["parse_mode"] = parse_mode
+    if reply_markup is not None:
+        entry["reply_markup"] = reply_markup.to_dict()
+    return entry
+
+def outbox_updates(entries: dict) -> dict:
+    """مسارات الإشعارات لإضافتها إلى تحديث متعدد المسارات: {مفتاح_عدم_التكرار: سجل}."""
+    return {f"outbox/{key}": entry for key, entry in entries.items()}
+
+class OutboxEntryGone(Exception):
+    """يُرفع داخل معاملة إشعار لإلغائها دون كتابة: الإشعار حُذف (أُرسل) أو أصبح محجوزاً لغيرنا."""
+
+def outbox_lease_update(holder: str, now: int, lease_until: int):
+    """
+    دالة تحديث لمعاملة حجز إشعار: تحجزه لـ holder إذا كان موجوداً، وكان محجوزاً له أصلاً (الإرسال الفوري بعد
+    إنشائه) أو انتهى حجزه. لا تُنشئ سجلاً ناقصاً لإشعار حُذف، والإشعار التالف (بلا chat_id أو text) يُحذف.
+    """
+    def _update(current):
+        if not current:
+            raise OutboxEntryGone()
+        if not isinstance(current, dict) or not current.get("chat_id") or not current.get("text"):
+            return None
+        if current.get("leased_by") != holder and current.get("next_attempt", 0) > now:
+            raise OutboxEntryGone()
+        return {**current, "leased_by": holder, "next_attempt": lease_until}
+    return _update
+
+def outbox_retry_update(holder: str, attempts: int, next_attempt: int, error: str):
+    """دالة تحديث لمعاملة تأجيل إشعار فشل إرساله، فقط إذا كان ما زال موجوداً ومحجوزاً لـ holder."""
+    def _update(current):
+        if not current or current.get("leased_by") != holder:
+            raise OutboxEntryGone()
+        return {**current, "attempts": attempts, "next_attempt": next_attempt, "last_error": error}
+    return _update
+
+class Outbox:
+    """
+    عامل صندوق الصادر: يرسل الإشعارات المستحقة دفعات عبر محرك الإرسال،
+    ويحذف الناجح منها، ويؤجل الفاشل بتأخير أُسّي حتى OUTBOX_MAX_ATTEMPTS ثم ينقله إلى /outbox_dead.
+    نتائج الإرسال تُجمع لمدة OUTBOX_ACK_DELAY وتُكتب معاً، فلا تضيف كل رسالة كتابة إلى القاعدة.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._in_flight = set()
+        self._acks = {}
+        self._flush_task = None
+        # مفاتيح أُرسلت في هذه العملية، لتجنب إعادة الإرسال إذا فشل حذفها من القاعدة
+        self._sent = OrderedDict()
+
+    def _remember_sent(self, key: str) -> None:
+        self._sent[key] = True
+        if len(self._sent) > OUTBOX_SENT_CACHE_SIZE:
+            self._sent.popitem(last=False)
+
+    @staticmethod
+    def _send_kwargs(bot, entry: dict) -> dict:
+        kwargs = {}
+        if entry.get("parse_mode"):
+            kwargs["parse_mode"] = entry["parse_mode"]
+        if entry.get("reply_markup"):
+            kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(entry["reply_markup"], bot)
+        return kwargs
+
+    async def flush(self) -> bool:
+        """كتابة نتائج الإرسال المتراكمة في تحديث واحد. يعيد False إذا فشلت الكتابة."""
+        updates, self._acks = self._acks, {}
+        if not updates:
+            return True
+        try:
+            await repo.update('/', updates)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to record outbox results, will retry: {e}")
+            self._acks = {**updates, **self._acks}
+            return False
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(OUTBOX_ACK_DELAY)
+        self._flush_task = None
+        await self.flush()
+
+    def _record(self, updates: dict) -> None:
+        self._acks.update(updates)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def deliver(self, bot, entries: dict) -> None:
+        """
+        حجز مجموعة إشعارات ثم إرسالها بشكل متزامن وتسجيل نتائجها مع الدفعة التالية من الكتابات.
+        الحجز يمر بنفس المعاملة الشرطية للإرسال الفوري وللتفريغ الدوري، فلا يرسل عاملان نفس الإشعار.
+        """
+        updates = {}
+        candidates = []
+        for key in entries:
+            if key in self._sent:
+                updates[f"outbox/{key}"] = None
+            elif key not in self._in_flight:
+                candidates.append(key)
+        self._in_flight.update(candidates)
+        try:
+            batch = await self._lease(candidates)
+            # استثناء غير متوقع في إشعار واحد (مثلاً reply_markup تالف) لا يوقف باقي الدفعة
+            results = await asyncio.gather(*(
+                dispatcher.send(bot, entry["chat_id"], entry["text"], **self._send_kwargs(bot, entry))
+                for entry in batch.values()), return_exceptions=True)
+            finished = now_ms()
+            retries = {}
+            for (key, entry), error in zip(batch.items(), results):
+                if error is None:
+                    self._remember_sent(key)
+                    updates[f"outbox/{key}"] = None
+                    continue
+                attempts = entry.get("attempts", 0) + 1
+                if isinstance(error, (BadRequest, Forbidden)) or attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Giving up on outbox message {key} to {entry['chat_id']} after {attempts} attempts: {error}")
+                    updates[f"outbox/{key}"] = None
+                    updates[f"outbox_dead/{key}"] = {**entry, "attempts": attempts, "error": str(error), "failed_at": finished}
+                else:
+                    delay = min(OUTBOX_BASE_DELAY * 2 ** (attempts - 1), OUTBOX_MAX_DELAY)
+                    retries[key] = outbox_retry_update(outbox_holder(), attempts, finished + int(delay * 1000), str(error))
+            metrics.inc("hr_bot_outbox_sent_total", value=sum(1 for error in results if error is None))
+            if updates:
+                self._record(updates)
+            await self._write_retries(retries)
+        finally:
+            self._in_flight.difference_update(candidates)
+
+    async def _write_retries(self, retries: dict) -> None:
+        """تأجيل الإشعارات الفاشلة بمعاملة شرطية لكل منها، فلا يُعاد إنشاء إشعار حذفه عامل آخر."""
+        results = await asyncio.gather(*(repo.transaction(f"/outbox/{key}", update) for key, update in retries.items()),
+                                       return_exceptions=True)
+        for key, result in zip(retries, results):
+            if isinstance(result, Exception) and not isinstance(result, OutboxEntryGone):
+                # يبقى محجوزاً حتى انتهاء المهلة ثم يعيد التفريغ الدوري المحاولة
+                logger.error(f"Failed to reschedule outbox message {key}: {result}")
+
+    async def _lease(self, keys: list) -> dict:
+        """
+        حجز الإشعارات المستحقة لهذه العملية بمعاملة شرطية لكل منها. يعيد {المفتاح: السجل المحجوز}
+        ويتخطى ما حُذف أو حجزه غيرنا، ويحذف الإشعارات التالفة.
+        """
+        now = now_ms()
+        lease_until = now + int(OUTBOX_LEASE * 1000)
+        holder = outbox_holder()
+        results = await asyncio.gather(*(repo.transaction(f"/outbox/{key}", outbox_lease_update(holder, now, lease_until))
+                                         for key in keys), return_exceptions=True)
+        leased = {}
+        for key, result in zip(keys, results):
+            if isinstance(result, OutboxEntryGone):
+                continue
+            if isinstance(result, Exception):
+                logger.error(f"Failed to lease outbox message {key}: {result}")
+            elif result is None:
+                logger.error(f"Dropped malformed outbox message {key} (missing chat_id or text)")
+            else:
+                leased[key] = result
+        return leased
+
+    async def drain(self, bot) -> None:
+        """إرسال كل الإشعارات المستحقة على دفعات. إذا كان هناك تفريغ جارٍ فلا داعي لتفريغ ثانٍ."""
+        if self._lock.locked():
+            return
+        async with self._lock:
+            # كتابة النتائج السابقة أولاً حتى لا يُعاد اختيار رسائل أُرسلت بالفعل
+            while await self.flush():
+                due = await repo.query('/outbox', order_by='next_attempt', end_at=now_ms(),
+                                       limit_to_first=OUTBOX_BATCH_SIZE)
+                due = {key: entry for key, entry in (due or {}).items() if key not in self._in_flight}
+                if not due:
+                    return
+                # deliver يحجز الدفعة قبل إرسالها، حتى لا يختارها تفريغ آخر (مثلاً بعد انتقال القيادة بين العمال)
+                await self.deliver(bot, due)
+                if len(due) < OUTBOX_BATCH_SIZE:
+                    return
+
+outbox = Outbox()
+
+async def drain_outbox(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    مهمة مجدولة: إرسال الإشعارات المحددة في بيانات المهمة، أو (في التفريغ الدوري) إكمال قرارات المدير
+    التي لم تُطبّق آثارها ثم إرسال كل المستحق في /outbox.
+    """
+    entries = context.job.data if context.job else None
+    if entries:
+        await outbox.deliver(context.bot, entries)
+    else:
+        await recover_decision_effects(context)
+        await outbox.drain(context.bot)
+
+def kick_outbox(context: ContextTypes.DEFAULT_TYPE, entries: dict) -> None:
+    """جدولة إرسال فوري للإشعارات التي كُتبت للتو، دون انتظارها داخل المعالج."""
+    if entries:
+        context.job_queue.run_once(instrument(drain_outbox), 0, data=entries)
+
+# --- طابور الكتابة المحلي عند تعذر الوصول إلى Firebase ---
+# إذا فشلت كتابة طلب جديد أو اقتراح يُحفظ التحديث متعدد المسارات كما هو في ملف SQLite (وضع WAL) ويُبلّغ المستخدم
+# بالاستلام، ثم يُعاد تطبيقه بالترتيب عند عودة الاتصال. إعادة التطبيق تنشئ السجل فقط إذا لم يكن موجوداً، فلا تعيد
+# طلباً عالجه المدير إلى حالة pending إذا كانت الكتابة الأصلية قد وصلت رغم فشل الرد.
+# ما دام الطابور غير فارغ تذهب الكتابات الجديدة إليه مباشرة، فلا يحاول كل مستخدم الاتصال بخادم معطل.
+WAL_PATH = os.getenv("WAL_PATH", "offline_queue.sqlite3")
+WAL_REPLAY_INTERVAL = float(os.getenv("WAL_REPLAY_INTERVAL", "10"))
+WAL_MAX_DELAY = float(os.getenv("WAL_MAX_DELAY", "300"))
+WAL_BATCH_SIZE = 50
+WAL_CLAIM_LEASE = 120 # مدة حجز الصفوف لعملية واحدة أثناء إعادة التطبيق (العمال على نفس الجهاز يتشاركون الملف)
+JOURNAL_COLLECTIONS = {**LEAVE_COLLECTIONS, "suggestion": "suggestions"}
+
+class WriteJournal:
+    """سجل محلي دائم للكتابات المؤجلة: (seq، مفتاح الطلب، النوع، التحديث بصيغة JSON، وقت الإضافة، المحاولات، آخر خطأ)."""
+
+    def __init__(self, path: str = WAL_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._replay_lock = asyncio.Lock()
+        self._delay = WAL_REPLAY_INTERVAL
+        self._next_attempt = 0.0
+        self.depth = 0
+        self.last_error = None
+
+    def _connection(self):
+        # يُنشأ الملف عند أول كتابة مؤجلة فقط
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._path, timeout=10, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "key TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, updates TEXT NOT NULL, "
+                               "created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, "
+                               "claimed_until REAL NOT NULL DEFAULT 0)")
+            self._conn.commit()
+        return self._conn
+
+    def _count(self) -> int:
+        self.depth = self._connection().execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+        metrics.set_gauge("hr_bot_wal_depth", (), self.depth)
+        return self.depth
+
+    def _append(self, key: str, kind: str, updates: dict) -> None:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO journal (key, kind, updates, created_at) VALUES (?, ?, ?, ?)",
+                             (key, kind, json.dumps(updates, ensure_ascii=False), time_ns() / 1e9))
+            self._count()
+
+    def _refresh_depth(self) -> int:
+        with self._lock:
+            return self._count()
+
+    def _claim_batch(self, limit: int) -> list:
+        """حجز دفعة من الصفوف غير المحجوزة لهذه العملية في معاملة واحدة، فلا يعيد عاملان تطبيق نفس الصف."""
+        now = time_ns() / 1e9
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                rows = conn.execute("SELECT seq, key, kind, updates FROM journal WHERE claimed_until < ? "
+                                    "ORDER BY seq LIMIT ?", (now, limit)).fetchall()
+                conn.executemany("UPDATE journal SET claimed_until = ? WHERE seq = ?",
+                                 [(now + WAL_CLAIM_LEASE, seq) for seq, *_ in rows])
+        return [(seq, key, kind, json.loads(updates)) for seq, key, kind, updates in rows]
+
+    def _remove(self, seq: int) -> None:
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self._count()
+
+    def _record_failure(self, seq: int, error: str, claimed: list) -> None:
+        """تسجيل فشل الصف seq وإلغاء حجز ما تبقى من الدفعة لتعيد أي عملية المحاولة بعد التأخير."""
+        with self._lock, self._connection() as conn:
+            conn.execute("UPDATE journal SET attempts = attempts + 1, last_error = ? WHERE seq = ?", (error, seq))
+            conn.executemany("UPDATE journal SET claimed_until = 0 WHERE seq = ?", [(s,) for s in claimed])
+
+    def _stats(self) -> dict:
+        with self._lock:
+            if self._conn is None and not os.path.exists(self._path):
+                return {"depth": 0}
+            conn = self._connection()
+            depth = self._count()
+            head = conn.execute("SELECT created_at, attempts, last_error FROM journal ORDER BY seq LIMIT 1").fetchone()
+            by_kind = dict(conn.execute("SELECT kind, COUNT(*) FROM journal GROUP BY kind").fetchall())
+        stats = {"depth": depth, "by_kind": by_kind}
+        if head:
+            stats.update(oldest_at=head[0], attempts=head[1], last_error=head[2])
+        return stats
+
+    async def load(self) -> None:
+        """عند الإقلاع: معرفة ما بقي في الطابور من تشغيل سابق."""
+        stats = await asyncio.to_thread(self._stats)
+        if stats["depth"]:
+            logger.warning(f"Offline write queue has {stats['depth']} pending writes from a previous run")
+
+    async def submit(self, key: str, kind: str, updates: dict) -> bool:
+        """
+        كتابة تحديث متعدد المسارات إلى Firebase، أو حفظه في الطابور إذا فشلت الكتابة أو كان الطابور غير فارغ.
+        يعيد True إذا كُتب مباشرة وFalse إذا أُجّل.
+        """
+        if self.depth == 0:
+            try:
+                await repo.update('/', updates)
+                return True
+            except Exception as e:
+                logger.warning(f"Firebase write for {kind} {key} failed, queueing it locally: {e}")
+                self.last_error = str(e)
+                self._next_attempt = monotonic() + self._delay
+        await asyncio.to_thread(self._append, key, kind, updates)
+        metrics.inc("hr_bot_wal_queued_total", (("kind", kind),))
+        return False
+
+    async def _apply(self, key: str, kind: str, updates: dict) -> dict:
+        """
+        تطبيق صف واحد إذا لم يكن سجله موجوداً في Firebase. يعيد الإشعارات التي كُتبت لإرسالها فوراً،
+        أو {} إذا كانت الكتابة قد وصلت من قبل (وربما عالج المدير الطلب بعدها) فلا يُكتب شيء.
+        """
+        if await repo.get(f"/{JOURNAL_COLLECTIONS[kind]}/{key}") is not None:
+            logger.info(f"Queued {kind} {key} already exists in Firebase, dropping it from the queue")
+            return {}
+        # حجز جديد للإشعارات من لحظة الكتابة الفعلية، وإلا التقطها التفريغ الدوري مع الإرسال الفوري
+        lease_until = now_ms() + int(OUTBOX_LEASE * 1000)
+        notifications = {path[len("outbox/"):]: {**entry, "leased_by": outbox_holder(), "next_attempt": lease_until}
+                         for path, entry in updates.items() if path.startswith("outbox/")}
+        await repo.update('/', {**updates, **outbox_updates(notifications)})
+        return notifications
+
+    async def replay(self, context: ContextTypes.DEFAULT_TYPE = None) -> int:
+        """
+        إعادة تطبيق الكتابات المؤجلة بترتيب إضافتها، والتوقف عند أول فشل مع تأخير أسّي. يعيد عدد ما طُبّق.
+        الطابور قد يكون مشتركاً بين عدة عمليات، لذلك يُحسب عمقه من الملف وتُحجز الصفوف قبل تطبيقها.
+        """
+        if monotonic() < self._next_attempt or self._replay_lock.locked():
+            return 0
+        if self._conn is None and not os.path.exists(self._path):
+            return 0
+        if await asyncio.to_thread(self._refresh_depth) == 0:
+            return 0
+        replayed = 0
+        async with self._replay_lock:
+            while rows := await asyncio.to_thread(self._claim_batch, WAL_BATCH_SIZE):
+                for index, (seq, key, kind, updates) in enumerate(rows):
+                    try:
+                        notifications = await self._apply(key, kind, updates)
+                    except Exception as e:
+                        self.last_error = str(e)
+                        self._delay = min(self._delay * 2, WAL_MAX_DELAY)
+                        self._next_attempt = monotonic() + self._delay
+                        await asyncio.to_thread(self._record_failure, seq, str(e),
+                                                [row[0] for row in rows[index:]])
+                        logger.warning(f"Replaying queued {kind} {key} failed, next attempt in {self._delay:.0f}s: {e}")
+                        return replayed
+                    await asyncio.to_thread(self._remove, seq)
+                    metrics.inc("hr_bot_wal_replayed_total", (("kind", kind),))
+                    replayed += 1
+                    if context is not None:
+                        kick_outbox(context, notifications)
+        self._delay = WAL_REPLAY_INTERVAL
+        self.last_error = None
+        logger.info(f"Replayed {replayed} queued writes to Firebase")
+        return replayed
+
+    async def stats(self) -> dict:
+        stats = await asyncio.to_thread(self._stats)
+        stats["next_attempt_in"] = max(0.0, self._next_attempt - monotonic())
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+journal = WriteJournal()
+
+async def replay_journal(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """مهمة دورية في كل عملية: الطابور ملف محلي قد يتشاركه العمال، وكل صف يُحجز ذرياً قبل إعادة تطبيقه."""
+    await journal.replay(context)
+
+async def queue_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """أمر /queue_status: عدد الكتابات المنتظرة في الطابور المحلي وعمر أقدمها، لمدير الموارد البشرية فقط."""
+    if not is_hr_user(update.effective_user.id):
+        await update.message.reply_text("هذا الأمر متاح لمدير الموارد البشرية فقط.")
+        return
+    stats = await journal.stats()
+    if not stats["depth"]:
+        await update.message.reply_text("✅ لا توجد طلبات بانتظار الحفظ. الاتصال بقاعدة البيانات يعمل بشكل طبيعي.")
+        return
+    kinds_ar = {"fd": "إجازات يومية", "hourly": "أذونات ساعية", "suggestion": "اقتراحات"}
+    lines = [f"📥 **طلبات بانتظار الحفظ في قاعدة البيانات: {stats['depth']}**"]
+    lines += [f"• {kinds_ar.get(kind, kind)}: {count}" for kind, count in stats["by_kind"].items()]
+    waiting_minutes = int((time_ns() / 1e9 - stats["oldest_at"]) // 60)
+    lines.append(f"أقدم طلب ينتظر منذ {waiting_minutes} دقيقة، وعدد محاولات إعادة إرساله {stats['attempts']}.")
+    lines.append(f"المحاولة التالية خلال {stats['next_attempt_in']:.0f} ثانية.")
+    if stats.get("last_error"):
+        last_error = stats["last_error"][:200].replace("`", "'")
+        lines.append(f"آخر خطأ: `{last_error}`")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
 
 # --- دوال المحادثة الرئيسية ---
 
@@ -299,6 +1531,7 @@ async def enter_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """يستقبل رسالة المستخدم ويعرض خيارات الخصوصية (الآن فقط خيار مجهول)."""
     message_text = update.message.text
     context.user_data['suggestion_text'] = message_text
+    context.user_data['submission_id'] = generate_push_id()
 
     keyboard = [
         [InlineKeyboardButton("🔒 إرسال كرسالة مجهولة", callback_data="sugg_anonymous")], # تم إزالة خيار إظهار الاسم
@@ -340,27 +1573,36 @@ async def confirm_suggestion(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     hr_message = f"📬 رسالة جديدة في صندوق الاقتراحات 📬\n\n**{sender_info}**\n\n---\n{suggestion_text}\n---"
     
-    # حفظ في Firebase
+    # حفظ الاقتراح وإشعار الموارد البشرية في صندوق الصادر بكتابة واحدة
+    suggestion_id = await claim_submission(context)
+    if suggestion_id is None:
+        await query.edit_message_text("✅ تم إرسال هذه الرسالة مسبقاً.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    notifications = {f"{suggestion_id}-hr": outbox_entry(hr_chat_id, hr_message, ParseMode.MARKDOWN)}
     try:
-        suggestions_ref = db.reference('/suggestions')
-        suggestions_ref.push().set({
-            'message': suggestion_text,
-            'sender_name': sender_name_for_db,
-            'sender_id': sender_id_for_db,
-            'sent_at': datetime.now().isoformat()
+        saved = await journal.submit(suggestion_id, "suggestion", {
+            f"suggestions/{suggestion_id}": {
+                'message': suggestion_text,
+                'sender_name': sender_name_for_db,
+                'sender_id': sender_id_for_db,
+                'sent_at': datetime.now().isoformat()
+            },
+            **outbox_updates(notifications),
         })
     except Exception as e:
         logger.error(f"Firebase error saving suggestion: {e}")
+        await idempotency.release_submission(suggestion_id)
         await query.edit_message_text("حدث خطأ أثناء حفظ رسالتك. يرجى المحاولة لاحقًا.")
         return ConversationHandler.END
+    if not saved:
+        await query.edit_message_text("✅ تم استلام رسالتك، وستصل إلى الإدارة تلقائياً فور عودة الاتصال بقاعدة البيانات. شكراً لمساهمتك.")
+        context.user_data.clear()
+        return ConversationHandler.END
 
-    # إرسال إلى الموارد البشرية
-    try:
-        await context.bot.send_message(chat_id=hr_chat_id, text=hr_message, parse_mode=ParseMode.MARKDOWN)
-        await query.edit_message_text("✅ تم إرسال رسالتك بنجاح. شكراً لمساهمتك.")
-    except Exception as e:
-        logger.error(f"Failed to send suggestion to HR: {e}")
-        await query.edit_message_text("حدث خطأ أثناء إرسال الرسالة إلى المدير. يرجى المحاولة لاحقًا.")
+    # الإرسال إلى الموارد البشرية يتم في الخلفية مع إعادة المحاولة عند الفشل
+    kick_outbox(context, notifications)
+    await query.edit_message_text("✅ تم إرسال رسالتك بنجاح. شكراً لمساهمتك.")
 
     context.user_data.clear() # مسح بيانات المستخدم بعد اكتمال العملية
     return ConversationHandler.END
@@ -433,6 +1675,7 @@ async def enter_hourly_name(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def enter_hourly_reason(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """الخطوة السادسة: حفظ سبب الإذن وعرض ملخص الطلب للتأكيد."""
     context.user_data['hourly_reason'] = update.message.text
+    context.user_data['submission_id'] = generate_push_id()
     leave_type = context.user_data['hourly_leave_type']
     type_text = "تأخير صباحي" if leave_type == 'late' else "مغادرة مبكرة"
     time_label = "وقت الوصول" if leave_type == 'late' else "وقت المغادرة"
@@ -466,31 +1709,18 @@ async def confirm_hourly_leave(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
     user = update.effective_user
-    leaves_ref = db.reference('/hourly_leaves')
-    new_leave_ref = leaves_ref.push()
-    request_id = new_leave_ref.key # الحصول على مفتاح الطلب الجديد
     leave_type = context.user_data['hourly_leave_type']
     type_text = "تأخير صباحي" if leave_type == 'late' else "مغادرة مبكرة"
     time_info = f"{type_text} - {context.user_data['selected_time']}"
     selected_date_obj = context.user_data['hourly_selected_date']
-    
-    # حفظ بيانات الطلب في Firebase
-    new_leave_ref.set({
-        "employee_name": context.user_data['employee_name'],
-        "employee_telegram_id": str(user.id),
-        "reason": context.user_data['hourly_reason'],
-        "date": selected_date_obj.strftime('%d/%m/%Y'),
-        "time_info": time_info,
-        "status": "pending", # حالة الطلب الأولية
-        "request_time": datetime.now().isoformat(),
-    })
-
-    hr_chat_id = get_hr_telegram_id()
-    if not hr_chat_id:
-        await query.edit_message_text("⚠️ خطأ إداري: لا يمكن العثور على حساب مدير الموارد البشرية. يرجى مراجعة الإدارة.")
-        return ConversationHandler.END
-
     selected_date_str = selected_date_obj.strftime('%d/%m/%Y')
+    # رمز الإرسال هو معرف الطلب: الضغط المزدوج أو إعادة التسليم لا ينشئ طلباً ثانياً
+    request_id = await claim_submission(context)
+    if request_id is None:
+        await query.edit_message_text("✅ تم إرسال هذا الطلب مسبقاً.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    hr_chat_id = get_hr_telegram_id()
     # رسالة الإشعار لمدير الموارد البشرية
     hr_message = (f"📣 **طلب إذن ساعي جديد** 📣\n\n"
                   f"**من الموظف:** {context.user_data['employee_name']}\n"
@@ -500,13 +1730,37 @@ async def confirm_hourly_leave(update: Update, context: ContextTypes.DEFAULT_TYP
                   "يرجى اتخاذ الإجراء المناسب.")
     # أزرار الموافقة والرفض لمدير الموارد البشرية
     keyboard = [[InlineKeyboardButton("✅ موافقة", callback_data=f"approve_hourly_{request_id}"), InlineKeyboardButton("❌ رفض", callback_data=f"reject_hourly_{request_id}")]]
-    
+    notifications = {}
+    if hr_chat_id:
+        notifications[f"{request_id}-hr"] = outbox_entry(hr_chat_id, hr_message, ParseMode.MARKDOWN, InlineKeyboardMarkup(keyboard))
+
+    # حفظ الطلب مع فهرس الموظف وطابور الموافقات وإشعار المدير في كتابة واحدة
     try:
-        await context.bot.send_message(chat_id=hr_chat_id, text=hr_message, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-        await query.edit_message_text("✅ تم إرسال طلبك بنجاح. سيتم إعلامك بالرد قريباً.")
+        saved = await create_leave_request('hourly', {
+            "employee_name": context.user_data['employee_name'],
+            "employee_telegram_id": str(user.id),
+            "reason": context.user_data['hourly_reason'],
+            "date": selected_date_str,
+            "time_info": time_info,
+            "status": "pending", # حالة الطلب الأولية
+            "request_time": datetime.now().isoformat(),
+            **leave_index_fields("pending", [selected_date_obj]),
+        }, request_id, notifications)
     except Exception as e:
-        logger.error(f"Failed to send hourly leave to HR: {e}")
+        logger.error(f"Failed to save hourly leave request: {e}")
+        await idempotency.release_submission(request_id)
         await query.edit_message_text("حدث خطأ أثناء إرسال الطلب. يرجى المحاولة مرة أخرى.")
+        return ConversationHandler.END
+
+    if not hr_chat_id:
+        await query.edit_message_text("⚠️ خطأ إداري: لا يمكن العثور على حساب مدير الموارد البشرية. يرجى مراجعة الإدارة.")
+        return ConversationHandler.END
+    if not saved:
+        await query.edit_message_text("✅ تم استلام طلبك. قاعدة البيانات غير متاحة حالياً، وسيُرسل طلبك إلى الإدارة تلقائياً فور عودة الاتصال.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    kick_outbox(context, notifications)
+    await query.edit_message_text("✅ تم إرسال طلبك بنجاح. سيتم إعلامك بالرد قريباً.")
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -623,15 +1877,9 @@ async def show_fd_confirmation(query, context):
         await query.edit_message_text("لم يتم اختيار أي تاريخ. تم إلغاء الطلب.")
         return ConversationHandler.END
         
-    date_info_str = ""
-    if duration_type == 'single':
-        date_info_str = selected_dates[0].strftime('%d/%m/%Y')
-    elif duration_type == 'range':
-        date_info_str = f"من {selected_dates[0].strftime('%d/%m/%Y')} إلى {selected_dates[-1].strftime('%d/%m/%Y')}"
-    elif duration_type == 'multiple':
-        date_info_str = ", ".join([d.strftime('%d/%m/%Y') for d in selected_dates])
-    context.user_data['final_date_info'] = date_info_str
-    
+    date_info_str = format_period(date_period(expand_selected_dates(duration_type, selected_dates)))
+    context.user_data['submission_id'] = generate_push_id()
+
     summary = (f"📋 **ملخص طلب الإجازة** 📋\n\n"
                f"👤 **اسم الموظف:** {context.user_data['employee_name']}\n"
                f"📝 **السبب:** {context.user_data['leave_reason']}\n"
@@ -659,51 +1907,152 @@ async def confirm_full_day_leave(update: Update, context: ContextTypes.DEFAULT_T
         return ConversationHandler.END
 
     user = update.effective_user
-    leaves_ref = db.reference('/full_day_leaves')
-    new_leave_ref = leaves_ref.push()
-    request_id = new_leave_ref.key # الحصول على مفتاح الطلب الجديد
-    new_leave_ref.set({
-        "employee_name": context.user_data['employee_name'],
-        "employee_telegram_id": str(user.id),
-        "reason": context.user_data['leave_reason'],
-        "date_info": context.user_data['final_date_info'],
-        "status": "pending", # حالة الطلب الأولية
-        "request_time": datetime.now().isoformat(),
-    })
-    
-    hr_chat_id = get_hr_telegram_id()
-    if not hr_chat_id:
-        await query.edit_message_text("⚠️ خطأ إداري: لا يمكن العثور على حساب مدير الموارد البشرية. يرجى مراجعة الإدارة.") # تحسين النص
+    # رمز الإرسال هو معرف الطلب: الضغط المزدوج أو إعادة التسليم لا ينشئ طلباً ثانياً
+    request_id = await claim_submission(context)
+    if request_id is None:
+        await query.edit_message_text("✅ تم إرسال هذا الطلب مسبقاً.")
+        context.user_data.clear()
         return ConversationHandler.END
-        
+    hr_chat_id = get_hr_telegram_id()
+    index_fields = leave_index_fields("pending", expand_selected_dates(context.user_data['duration_type'], context.user_data['selected_dates']))
+
+    # الموظفون الآخرون الذين لديهم إجازة مقبولة في نفس الأيام، ليعرف المدير أثر الموافقة على الفريق
+    overlaps = coverage.overlaps(period_dates(index_fields['period']), exclude_employee=str(user.id)) if coverage.ready else {}
+    overlap_text = f"**غائبون في نفس الأيام:**\n{format_overlaps(overlaps)}\n\n" if overlaps else ""
+
     # رسالة الإشعار لمدير الموارد البشرية
     hr_message = (f"📣 **طلب إجازة يومية جديد** 📣\n\n" # تحسين النص
                   f"**من:** {context.user_data['employee_name']}\n"
                   f"**السبب:** {context.user_data['leave_reason']}\n"
-                  f"**التاريخ/المدة:** {context.user_data['final_date_info']}\n\n"
+                  f"**التاريخ/المدة:** {format_period(index_fields['period'])}\n\n"
+                  f"{overlap_text}"
                   "يرجى اتخاذ الإجراء المناسب.")
                   
     # أزرار الموافقة والرفض لمدير الموارد البشرية
     keyboard = [[InlineKeyboardButton("✅ موافقة", callback_data=f"approve_fd_{request_id}"), InlineKeyboardButton("❌ رفض", callback_data=f"reject_fd_{request_id}")]]
-    
+    notifications = {}
+    if hr_chat_id:
+        notifications[f"{request_id}-hr"] = outbox_entry(hr_chat_id, hr_message, ParseMode.MARKDOWN, InlineKeyboardMarkup(keyboard))
+
+    # حفظ الطلب مع فهرس الموظف وطابور الموافقات وإشعار المدير في كتابة واحدة
     try:
-        await context.bot.send_message(chat_id=hr_chat_id, text=hr_message, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
-        await query.edit_message_text("✅ تم إرسال طلبك بنجاح. سيتم إعلامك بالرد قريباً.")
+        saved = await create_leave_request('fd', {
+            "employee_name": context.user_data['employee_name'],
+            "employee_telegram_id": str(user.id),
+            "reason": context.user_data['leave_reason'],
+            "status": "pending", # حالة الطلب الأولية
+            "request_time": datetime.now().isoformat(),
+            **index_fields,
+        }, request_id, notifications)
     except Exception as e:
-        logger.error(f"Failed to send full day leave to HR: {e}")
+        logger.error(f"Failed to save full day leave request: {e}")
+        await idempotency.release_submission(request_id)
         await query.edit_message_text("حدث خطأ أثناء إرسال الطلب. يرجى المحاولة مرة أخرى.")
-        
+        return ConversationHandler.END
+
+    if not hr_chat_id:
+        await query.edit_message_text("⚠️ خطأ إداري: لا يمكن العثور على حساب مدير الموارد البشرية. يرجى مراجعة الإدارة.") # تحسين النص
+        return ConversationHandler.END
+    if not saved:
+        await query.edit_message_text("✅ تم استلام طلبك. قاعدة البيانات غير متاحة حالياً، وسيُرسل طلبك إلى الإدارة تلقائياً فور عودة الاتصال.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    kick_outbox(context, notifications)
+    await query.edit_message_text("✅ تم إرسال طلبك بنجاح. سيتم إعلامك بالرد قريباً.")
+
     context.user_data.clear()
     return ConversationHandler.END
 
 # --- معالج إجراءات المدير ---
+def decision_messages(leave_type_key: str, leave_request: dict, status: str) -> tuple:
+    """نص إشعار الموظف ونص إشعار قادة الفرق (عند الموافقة فقط) لقرار المدير."""
+    full_date_info = leave_details_text(leave_type_key, leave_request)
+    if status != "approved":
+        return f"للأسف، تم رفض طلبك بخصوص: **{full_date_info}**. يرجى مراجعة مديرك المباشر.", None
+    # الاسم يُدخله المستخدم، وأي رمز Markdown فيه يُفشل إرسال الرسالة (أو الملخص كاملاً)
+    employee_name = escape_markdown(leave_request.get('employee_name', 'موظف'))
+    if leave_type_key == 'fd':
+        leader_message_intro = f"تم منح الموظف ({employee_name}) موافقة بخصوص غياب في التاريخ/ التواريخ التالية:"
+    else: # hourly
+        leader_message_intro = f"تم منح الموظف ({employee_name}) موافقة بخصوص إذن:"
+    return (f"🎉 تهانينا! تمت الموافقة على طلبك بخصوص: **{full_date_info}**.",
+            f"{leader_message_intro}\n`{full_date_info}`")
+
+def decision_effects(leave_type_key: str, request_id: str, leave_request: dict, status: str) -> dict:
+    """آثار قرار المدير التي تُحفظ داخل السجل مع تغيير الحالة: تحديثات الفهارس، زيادات العدادات، والإشعارات."""
+    employee_text, leader_body = decision_messages(leave_type_key, leave_request, status)
+    return {
+        "updates": leave_status_index_updates(request_id, leave_request, status),
+        "increments": leave_counter_increments(leave_type_key, leave_request, status),
+        "notifications": {f"{request_id}-{status}-employee": outbox_entry(
+            leave_request["employee_telegram_id"], employee_text, ParseMode.MARKDOWN)},
+        "leader_body": leader_body,
+    }
+
+def apply_decision_effects(decisions: list, leader_ids: list, leader_digest: bool = False) -> tuple:
+    """
+    تحديث واحد متعدد المسارات يطبّق آثار القرارات المحفوظة [(النوع، المعرف، السجل)] ويمسحها من السجلات معاً،
+    فلا تُطبّق مرتين. إشعار قادة الفرق يكون رسالة لكل قرار، أو رسالة واحدة تجمعها عند leader_digest.
+    يعيد (التحديث، الإشعارات).
+    """
+    updates, increments, notifications, leader_bodies = {}, {}, {}, []
+    for leave_type_key, request_id, record in decisions:
+        effects = json.loads(record["pending_effects"])
+        updates.update(effects["updates"])
+        # قد تتكرر نفس العدادات لعدة طلبات لنفس الموظف، لذلك نجمعها قبل الكتابة
+        for path, amount in effects["increments"].items():
+            increments[path] = increments.get(path, 0) + amount
+        notifications.update(effects["notifications"])
+        if effects["leader_body"] and not leader_digest:
+            for leader_id in leader_ids:
+                notifications[f"{request_id}-{record['status']}-leader-{leader_id}"] = outbox_entry(
+                    leader_id, f"🔔 إشعار إجازة/إذن 🔔\n\n{effects['leader_body']}", ParseMode.MARKDOWN)
+        elif effects["leader_body"]:
+            leader_bodies.append(effects["leader_body"])
+        collection = LEAVE_COLLECTIONS[leave_type_key]
+        updates[f"{collection}/{request_id}/pending_effects"] = None
+        updates[f"{collection}/{request_id}/effects_at"] = None
+    updates.update({path: {".sv": {"increment": amount}} for path, amount in increments.items()})
+    # رسالة واحدة لكل قائد فريق تجمع كل الموافقات بدلاً من رسالة لكل طلب
+    if leader_bodies:
+        leader_notification = "🔔 إشعار إجازات/أذونات 🔔\n\n" + "\n\n".join(leader_bodies)
+        digest_id = generate_push_id()
+        for leader_id in leader_ids:
+            notifications[f"{digest_id}-approved-leader-{leader_id}"] = outbox_entry(
+                leader_id, leader_notification, ParseMode.MARKDOWN)
+    updates.update(outbox_updates(notifications))
+    return updates, notifications
+
+async def recover_decision_effects(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    تطبيق آثار القرارات التي حُفظت مع الحالة ولم تُطبّق (توقف العملية أو فشل الكتابة التالية).
+    يُنتظر OUTBOX_LEASE قبل التقاط القرار حتى لا يُطبّق بالتوازي مع المعالج الذي اتخذه. يعيد عدد القرارات.
+    """
+    cutoff = now_ms() - int(OUTBOX_LEASE * 1000)
+    pages = await asyncio.gather(*(
+        repo.query(f'/{collection}', order_by='effects_at', start_at=0, end_at=cutoff, limit_to_first=OUTBOX_BATCH_SIZE)
+        for collection in LEAVE_COLLECTIONS.values()))
+    decisions = [(leave_type_key, request_id, record)
+                 for leave_type_key, page in zip(LEAVE_COLLECTIONS, pages)
+                 for request_id, record in (page or {}).items() if record.get("pending_effects")]
+    if not decisions:
+        return 0
+    updates, notifications = apply_decision_effects(decisions, get_all_team_leaders_ids())
+    await repo.update('/', updates)
+    logger.warning(f"Applied {len(decisions)} unfinished HR decisions")
+    await outbox.deliver(context.bot, notifications)
+    return len(decisions)
+
 async def hr_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     يتعامل مع أفعال مدير الموارد البشرية (الموافقة أو الرفض) على طلبات الإجازات والأذونات.
     يرسل إشعاراً للموظف وقادة الفرق المعنيين.
     """
     query = update.callback_query
-    await query.answer()
+    # أزرار الموافقة تُرسل لمدير الموارد البشرية فقط، لكن بيانات الزر يمكن تزويرها
+    if not is_hr_user(query.from_user.id):
+        await query.answer("هذا الإجراء متاح لمدير الموارد البشرية فقط.", show_alert=True)
+        return
     
     parts = query.data.split("_")
     action = parts[0] # "approve" أو "reject"
@@ -714,156 +2063,969 @@ async def hr_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     request_id = query.data[len(prefix):]
     
     # تحديد مسار قاعدة البيانات بناءً على نوع الإجازة
-    leave_type_db = "full_day_leaves" if leave_type_key == "fd" else "hourly_leaves"
-    db_path = f"/{leave_type_db}/{request_id}"
-    leave_ref = db.reference(db_path)
-    leave_request = leave_ref.get()
-
-    if not leave_request:
-        await query.edit_message_text("❌ خطأ فني: لم يتم العثور على هذا الطلب. قد يكون قد تم حذفه أو أن المعرّف غير صحيح.")
-        logger.error(f"Could not find leave request at path: {db_path}")
-        return
+    db_path = f"/{LEAVE_COLLECTIONS[leave_type_key]}/{request_id}"
+    new_status = "approved" if action == "approve" else "rejected"
 
-    # التحقق مما إذا كان الطلب قد تمت معالجته بالفعل
-    if leave_request.get("status") != "pending":
-        status_ar = "مقبول ✅" if leave_request.get("status") == "approved" else "مرفوض ❌"
-        await query.answer(f"تنبيه: هذا الطلب تمت معالجته بالفعل وحالته الآن: {status_ar}", show_alert=True)
+    # تغيير الحالة كعملية شرطية واحدة: فقط الجلسة الفائزة تكمل وترسل الإشعارات
+    try:
+        # النسخة المحلية تكفي لرفض النقر على طلب عولج بالفعل دون طلب شبكة،
+        # أما الطلب المعلق (أو غير الموجود محلياً بعد) فيمر دائماً بالمعاملة الشرطية
+        cached = replica.get(leave_type_key, request_id) if replica.ready else None
+        if cached and cached.get("status") != "pending":
+            raise LeaveTransitionAborted(cached.get("status"))
+        replica.note_write(leave_type_key, request_id)
+        leave_request = await repo.transaction(db_path, pending_status_transition(
+            new_status, lambda current: decision_effects(leave_type_key, request_id, current, new_status)))
+    except LeaveTransitionAborted as e:
+        if e.status is None:
+            await query.answer()
+            await query.edit_message_text("❌ خطأ فني: لم يتم العثور على هذا الطلب. قد يكون قد تم حذفه أو أن المعرّف غير صحيح.")
+            logger.error(f"Could not find leave request at path: {db_path}")
+        else:
+            # الطلب تمت معالجته بالفعل (من جلسة أخرى أو نقرة مزدوجة)
+            status_ar = "مقبول ✅" if e.status == "approved" else "مرفوض ❌"
+            await query.answer(f"تنبيه: هذا الطلب تمت معالجته بالفعل وحالته الآن: {status_ar}", show_alert=True)
         return
+    await query.answer()
+    if new_status == "approved":
+        if leave_type_key == 'fd':
+            coverage.add(request_id, leave_request)
+        schedule_reminder(context.job_queue, leave_type_key, request_id, leave_request)
 
-    employee_name = leave_request.get('employee_name', 'موظف')
     hr_user = query.from_user # المدير الذي اتخذ الإجراء
-    
-    full_date_info = ""
-    leader_message_intro = ""
-    if leave_type_key == 'fd':
-        full_date_info = leave_request.get('date_info', 'غير محدد')
-        leader_message_intro = f"تم منح الموظف ({employee_name}) موافقة بخصوص غياب في التاريخ/ التواريخ التالية:"
-    else: # hourly
-        leave_date = leave_request.get('date', 'بتاريخ اليوم')
-        time_details = leave_request.get('time_info', 'وقت غير محدد')
-        full_date_info = f"{time_details} بتاريخ {leave_date}"
-        leader_message_intro = f"تم منح الموظف ({employee_name}) موافقة بخصوص إذن:"
+    response_text = "✅ تمت الموافقة على الطلب" if action == "approve" else "❌ تم رفض الطلب"
+    leader_ids = get_all_team_leaders_ids()
+    if new_status == "approved" and leader_ids:
+        response_text += "\n(تم إشعار قادة الفرق)"
 
-    if action == "approve":
-        leave_ref.update({"status": "approved"})
-        response_text = "✅ تمت الموافقة على الطلب"
-        user_notification = f"🎉 تهانينا! تمت الموافقة على طلبك بخصوص: **{full_date_info}**."
-        
-        # إرسال إشعار لقادة الفرق عند الموافقة
-        leader_ids = get_all_team_leaders_ids()
-        if leader_ids:
-            leader_notification = f"🔔 إشعار إجازة/إذن 🔔\n\n{leader_message_intro}\n`{full_date_info}`" # تحسين النص
-            for leader_id in leader_ids:
-                try:
-                    await context.bot.send_message(chat_id=leader_id, text=leader_notification, parse_mode=ParseMode.MARKDOWN)
-                except Exception as e:
-                    logger.error(f"Failed to send notification to Team Leader {leader_id}: {e}")
-            response_text += "\n(تم إشعار قادة الفرق)"
-            
-    else: # action == "reject"
-        leave_ref.update({"status": "rejected"})
-        response_text = "❌ تم رفض الطلب"
-        user_notification = f"للأسف، تم رفض طلبك بخصوص: **{full_date_info}**. يرجى مراجعة مديرك المباشر."
-    
-    # إرسال إشعار للموظف صاحب الطلب
+    # تطبيق آثار القرار المحفوظة في السجل (الفهارس وعدادات الرصيد والإشعارات) في كتابة واحدة
+    updates, notifications = apply_decision_effects([(leave_type_key, request_id, leave_request)], leader_ids)
     try:
-        await context.bot.send_message(chat_id=leave_request["employee_telegram_id"], text=user_notification, parse_mode=ParseMode.MARKDOWN)
+        await repo.update('/', updates)
     except Exception as e:
-        logger.error(f"Failed to send notification to employee {leave_request['employee_telegram_id']}: {e}")
-        
+        # القرار وآثاره محفوظة في السجل، وسيطبقها التفريغ الدوري لصندوق الصادر
+        logger.error(f"Failed to apply decision effects for {db_path}, leaving them for recovery: {e}")
+    else:
+        # إشعار الموظف صاحب الطلب وقادة الفرق في الخلفية، حتى لا ينتظر المدير اكتمال الإرسال
+        kick_outbox(context, notifications)
+
     # تحديث رسالة المدير الأصلية بحالة الطلب ومن قام بالمعالجة
     original_message = query.message.text
     final_text = f"{original_message}\n\n--- [ {response_text} بواسطة: {hr_user.first_name} ] ---"
     await query.edit_message_text(text=final_text)
 
-# --- قسم التذكيرات (جديد) ---
-def parse_start_date(date_info: str) -> date | None:
+# --- لوحة الطلبات المعلقة لمدير الموارد البشرية ---
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", "10"))
+PENDING_PAGES_KEPT = 5 # عدد الصفحات المعروضة التي يمكن الموافقة عليها من رسائل سابقة
+HR_COMMANDS = [
+    BotCommand("start", "العودة إلى القائمة الرئيسية"),
+    BotCommand("pending", "الطلبات المعلقة بانتظار الموافقة"),
+    BotCommand("export", "تصدير تقرير الإجازات والاقتراحات"),
+    BotCommand("coverage", "الغائبون في تاريخ محدد"),
+    BotCommand("queue_status", "الطلبات بانتظار الحفظ عند انقطاع قاعدة البيانات"),
+]
+
+def is_hr_user(user_id) -> bool:
+    """التحقق من أن المستخدم مدير موارد بشرية حسب دليل المستخدمين."""
+    user = get_predefined_user(str(user_id))
+    return bool(user and user.get("role") == "hr")
+
+async def set_hr_commands(bot) -> None:
+    """إظهار أوامر المدير في قائمة الأوامر لمحادثته فقط."""
+    hr_chat_id = get_hr_telegram_id()
+    if not hr_chat_id:
+        return
+    try:
+        await bot.set_my_commands(HR_COMMANDS, scope=BotCommandScopeChat(hr_chat_id))
+    except Exception as e:
+        logger.error(f"Failed to set HR commands for {hr_chat_id}: {e}")
+
+async def load_pending_page(cursor: str) -> tuple:
     """
-    تحليل نص تاريخ الإجازة لاستخراج تاريخ البدء.
-    يعالج الحالات: يوم واحد، نطاق، أيام متعددة.
+    جلب صفحة من طابور الموافقات مرتبة حسب المفتاح (أي حسب وقت الطلب) ابتداءً من المؤشر.
+    يتم جلب عنصر إضافي لمعرفة مؤشر الصفحة التالية دون استعلام ثانٍ.
+    """
+    page = await repo.query('/pending_approvals', order_by='$key', start_at=cursor or None,
+                            limit_to_first=PENDING_PAGE_SIZE + 1)
+    items = list((page or {}).items())
+    next_cursor = items[PENDING_PAGE_SIZE][0] if len(items) > PENDING_PAGE_SIZE else None
+    return items[:PENDING_PAGE_SIZE], next_cursor
+
+def remember_pending_page(context: ContextTypes.DEFAULT_TYPE, cursor: str, items: list) -> str:
     """
+    حفظ معرفات الطلبات المعروضة في الصفحة تحت رمز يُرسل في زر "الموافقة على الكل"،
+    فتتم الموافقة على ما رآه المدير فعلاً وليس على ما يعيده الاستعلام لحظة الضغط.
+    """
+    pages = context.user_data.setdefault("pending_pages", {})
+    token = secrets.token_hex(4)
+    pages[token] = {"cursor": cursor, "ids": [[request_id, entry.get("type")] for request_id, entry in items]}
+    while len(pages) > PENDING_PAGES_KEPT:
+        pages.pop(next(iter(pages)))
+    return token
+
+def render_pending_page(items: list, cursor: str, next_cursor, token: str) -> tuple:
+    """نص الصفحة وأزرارها: الموافقة على الكل، الصفحة التالية، والعودة للبداية."""
+    if not items:
+        text = "📭 لا توجد طلبات معلقة حالياً." if not cursor else "📭 لا توجد طلبات معلقة في هذه الصفحة."
+    else:
+        lines = ["📥 **الطلبات المعلقة بانتظار الموافقة:**", ""]
+        for number, (_, entry) in enumerate(items, start=1):
+            type_text = LEAVE_TYPE_LABELS_AR.get(entry.get("type"), "طلب")
+            lines.append(f"{number}. {escape_markdown(entry.get('employee_name', 'موظف'))} — {type_text}: {entry.get('details', entry.get('start_date', ''))}")
+        text = "\n".join(lines)
+    buttons = []
+    if items:
+        buttons.append([InlineKeyboardButton(f"✅ الموافقة على الكل ({len(items)})", callback_data=f"pending_approve_{token}")])
+    navigation = []
+    if cursor:
+        navigation.append(InlineKeyboardButton("⏮ البداية", callback_data="pending_page_"))
+    navigation.append(InlineKeyboardButton("🔄 تحديث", callback_data=f"pending_page_{cursor}"))
+    if next_cursor:
+        navigation.append(InlineKeyboardButton("التالي ⬅️", callback_data=f"pending_page_{next_cursor}"))
+    buttons.append(navigation)
+    return text, InlineKeyboardMarkup(buttons)
+
+async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """أمر /pending: يعرض الصفحة الأولى من الطلبات المعلقة لمدير الموارد البشرية فقط."""
+    if not is_hr_user(update.effective_user.id):
+        await update.message.reply_text("هذا الأمر متاح لمدير الموارد البشرية فقط.")
+        return
     try:
-        # الحالة: "من 01/08/2024 إلى 05/08/2024"
-        if "من" in date_info:
-            date_str = date_info.split(" ")[1]
-            return datetime.strptime(date_str, "%d/%m/%Y").date()
-        # الحالة: "01/08/2024, 03/08/2024"
-        elif "," in date_info:
-            date_str = date_info.split(",")[0].strip()
-            return datetime.strptime(date_str, "%d/%m/%Y").date()
-        # الحالة: "01/08/2024"
+        items, next_cursor = await load_pending_page("")
+    except Exception as e:
+        logger.error(f"Failed to load pending approvals: {e}")
+        await update.message.reply_text("حدث خطأ أثناء جلب الطلبات المعلقة. يرجى المحاولة لاحقًا.")
+        return
+    text, reply_markup = render_pending_page(items, "", next_cursor, remember_pending_page(context, "", items))
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
+async def approve_pending_page(context: ContextTypes.DEFAULT_TYPE, page_ids: list) -> int:
+    """
+    الموافقة على الطلبات التي عُرضت في الصفحة [(المعرف، النوع)]: كل طلب يمر بنفس المعاملة الشرطية للموافقة الفردية
+    (بالتوازي)، فيُتخطى ما لم يعد معلقاً. ثم تُطبّق آثار كل الموافقات في كتابة واحدة مع رسالة واحدة لكل قائد فريق.
+    """
+    page_ids = [(request_id, leave_type_key) for request_id, leave_type_key in page_ids if leave_type_key in LEAVE_COLLECTIONS]
+    results = await asyncio.gather(*(
+        repo.transaction(f"/{LEAVE_COLLECTIONS[leave_type_key]}/{request_id}", pending_status_transition(
+            "approved", functools.partial(decision_effects, leave_type_key, request_id, status="approved")))
+        for request_id, leave_type_key in page_ids), return_exceptions=True)
+    decisions, updates, notifications = [], {}, {}
+    for (request_id, leave_type_key), result in zip(page_ids, results):
+        if isinstance(result, LeaveTransitionAborted):
+            if result.status is None:
+                # الطلب حُذف: تنظيف الطابور فقط
+                updates[f"pending_approvals/{request_id}"] = None
+            continue
+        if isinstance(result, Exception):
+            logger.error(f"Failed to approve {leave_type_key} request {request_id}: {result}")
+            continue
+        decisions.append((leave_type_key, request_id, result))
+    if decisions:
+        effects_updates, notifications = apply_decision_effects(decisions, get_all_team_leaders_ids(), leader_digest=True)
+        updates.update(effects_updates)
+    if updates:
+        try:
+            await repo.update('/', updates)
+        except Exception as e:
+            # الموافقات وآثارها محفوظة في السجلات، وسيطبقها التفريغ الدوري لصندوق الصادر
+            logger.error(f"Failed to apply bulk approval effects, leaving them for recovery: {e}")
+            notifications = {}
+    for leave_type_key, request_id, leave_request in decisions:
+        if leave_type_key == 'fd':
+            coverage.add(request_id, leave_request)
+        schedule_reminder(context.job_queue, leave_type_key, request_id, leave_request)
+    kick_outbox(context, notifications)
+    return len(decisions)
+
+async def pending_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """التنقل بين صفحات الطلبات المعلقة أو الموافقة على الطلبات المعروضة في صفحة."""
+    query = update.callback_query
+    if not is_hr_user(query.from_user.id):
+        await query.answer("هذا الإجراء متاح لمدير الموارد البشرية فقط.", show_alert=True)
+        return
+    _, action, argument = query.data.split("_", 2)
+    notice = None
+    cursor = argument
+    if action == "approve":
+        page = context.user_data.get("pending_pages", {}).pop(argument, None)
+        if page is None:
+            await query.answer("انتهت صلاحية هذه الصفحة. يرجى تحديثها ثم المحاولة مرة أخرى.", show_alert=True)
+            return
+        cursor = page["cursor"]
+    try:
+        if action == "approve":
+            approved = await approve_pending_page(context, page["ids"])
+            notice = f"✅ تمت الموافقة على {approved} طلب/طلبات."
+        items, next_cursor = await load_pending_page(cursor)
+    except Exception as e:
+        logger.error(f"Failed to process pending page ({query.data}): {e}")
+        await query.answer("حدث خطأ أثناء معالجة الطلبات المعلقة. يرجى المحاولة لاحقًا.", show_alert=True)
+        return
+    await query.answer(notice)
+    text, reply_markup = render_pending_page(items, cursor, next_cursor, remember_pending_page(context, cursor, items))
+    if notice:
+        text = f"{notice}\n\n{text}"
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as e:
+        # عند الضغط على "تحديث" دون تغيّر المحتوى
+        if "not modified" not in str(e).lower():
+            raise
+
+# --- سجل طلبات الموظف ورصيده ---
+MY_LEAVES_LIMIT = int(os.getenv("MY_LEAVES_LIMIT", "10"))
+STATUS_LABELS_AR = {"pending": "⏳ قيد المراجعة", "approved": "✅ مقبول", "rejected": "❌ مرفوض"}
+LEAVE_TYPE_LABELS_AR = {"fd": "إجازة يومية", "hourly": "إذن ساعي"}
+
+async def my_leaves(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    أمر /my_leaves: يعرض آخر طلبات الموظف وحالتها ورصيد السنة الحالية.
+    البيانات تأتي من فهرس الموظف والعدادات، فلا يعتمد زمن الاستجابة على حجم سجل الشركة.
+    """
+    user_id = str(update.effective_user.id)
+    year = date.today().year
+    try:
+        if replica.ready:
+            recent = {request_id: {"type": leave_type_key, "status": record.get("status"),
+                                   "details": leave_details_text(leave_type_key, record)}
+                      for leave_type_key, request_id, record in replica.employee_recent(user_id, MY_LEAVES_LIMIT)}
+            counters = await repo.get(f'/leave_counters/{user_id}/{year}')
         else:
-            return datetime.strptime(date_info, "%d/%m/%Y").date()
-    except (ValueError, IndexError) as e:
-        logger.error(f"Could not parse date from string '{date_info}': {e}")
-        return None
+            recent, counters = await asyncio.gather(
+                repo.query(f'/employee_leaves/{user_id}', order_by='$key', limit_to_last=MY_LEAVES_LIMIT),
+                repo.get(f'/leave_counters/{user_id}/{year}'),
+            )
+    except Exception as e:
+        logger.error(f"Failed to load leave history for {user_id}: {e}")
+        await update.message.reply_text("حدث خطأ أثناء جلب سجل طلباتك. يرجى المحاولة لاحقًا.")
+        return
+
+    counters = counters or {}
+    lines = [f"📊 **رصيدك لعام {year}**",
+             f"🗓️ أيام الإجازة المعتمدة: {counters.get('approved_days', 0)}",
+             f"🕒 الأذونات الساعية المعتمدة: {counters.get('approved_hourly', 0)}",
+             f"❌ الطلبات المرفوضة: {counters.get('rejected', 0)}",
+             "",
+             "📋 **آخر طلباتك:**"]
+    if not recent:
+        lines.append("لا توجد طلبات مسجلة بعد.")
+    # المفاتيح مرتبة زمنياً، لذلك نعرض الأحدث أولاً
+    for entry in reversed(list(recent.values())):
+        type_text = LEAVE_TYPE_LABELS_AR.get(entry.get("type"), "طلب")
+        status_text = STATUS_LABELS_AR.get(entry.get("status"), entry.get("status", ""))
+        lines.append(f"• {type_text}: {entry.get('details', '')} — {status_text}")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
+# --- أرشفة السجلات القديمة ---
+# الطلبات المغلقة الأقدم من نافذة الاحتفاظ تُنقل من المجموعات النشطة إلى أرشيف JSONL مضغوط مقسّم حسب الشهر،
+# فيبقى حجم المجموعات النشطة محدوداً بالنافذة لا بعمر الشركة. الأرشيف يُكتب أولاً ثم يُحذف الأصل بكتابة واحدة.
+ARCHIVE_BACKEND = os.getenv("ARCHIVE_BACKEND", "firebase") # firebase أو local أو none
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "archive")
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", str(24 * 3600)))
+ARCHIVE_PAGE_SIZE = 500
+
+def encode_archive_chunk(records: list) -> bytes:
+    """سطر JSON لكل سجل: {"id": المفتاح, "record": السجل}، مضغوطاً بـ gzip."""
+    lines = "".join(json.dumps({"id": key, "record": record}, ensure_ascii=False) + "\n" for key, record in records)
+    return gzip.compress(lines.encode("utf-8"))
+
+def decode_archive_chunk(data: bytes) -> list:
+    # gzip.decompress يقرأ أيضاً عدة أجزاء مضغوطة متتالية في نفس الملف
+    lines = gzip.decompress(data).decode("utf-8").splitlines()
+    return [(item["id"], item["record"]) for item in map(json.loads, lines) if item]
+
+class LocalArchive:
+    """ملف لكل شهر: {ARCHIVE_PATH}/{collection}/{year}/{YYYY-MM}.jsonl.gz، وكل دفعة تُضاف كجزء gzip جديد."""
+
+    def __init__(self, root: str = ARCHIVE_PATH):
+        self._root = root
+
+    def _path(self, collection: str, month: str) -> str:
+        return os.path.join(self._root, collection, month[:4], f"{month}.jsonl.gz")
+
+    def write(self, collection: str, month: str, records: list) -> None:
+        path = self._path(collection, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as archive_file:
+            archive_file.write(encode_archive_chunk(records))
+            archive_file.flush()
+            # يجب أن يصل الأرشيف إلى القرص قبل حذف السجلات من Firebase
+            os.fsync(archive_file.fileno())
+
+    def read(self, collection: str, month: str) -> list:
+        try:
+            with open(self._path(collection, month), "rb") as archive_file:
+                return decode_archive_chunk(archive_file.read())
+        except FileNotFoundError:
+            return []
+
+class FirebaseArchive:
+    """/archive/{year}/{collection}/{YYYY-MM}/{chunk_id} = دفعة JSONL مضغوطة بترميز base64."""
+
+    def __init__(self, root: str = "/archive"):
+        self._root = root
+
+    def write(self, collection: str, month: str, records: list) -> None:
+        init_firebase()
+        chunk = base64.b64encode(encode_archive_chunk(records)).decode("ascii")
+        db.reference(f"{self._root}/{month[:4]}/{collection}/{month}/{generate_push_id()}").set(chunk)
+
+    def read(self, collection: str, month: str) -> list:
+        init_firebase()
+        chunks = db.reference(f"{self._root}/{month[:4]}/{collection}/{month}").get() or {}
+        return [item for _, chunk in sorted(chunks.items()) for item in decode_archive_chunk(base64.b64decode(chunk))]
+
+def create_archive():
+    """واجهة الأرشيف حسب ARCHIVE_BACKEND، أو None لتعطيل الأرشفة."""
+    if ARCHIVE_BACKEND == "local":
+        return LocalArchive()
+    if ARCHIVE_BACKEND == "firebase":
+        return FirebaseArchive()
+    return None
+
+archive = create_archive()
+
+def month_range(date_from: date, date_to: date) -> list:
+    """أسماء أقسام الأرشيف (YYYY-MM) التي تغطي الفترة."""
+    months, current = [], date_from.replace(day=1)
+    while current <= date_to:
+        months.append(current.strftime("%Y-%m"))
+        current = (current + timedelta(days=32)).replace(day=1)
+    return months
+
+async def read_archive(collection: str, date_from: date, date_to: date):
+    """
+    مولّد غير متزامن يعيد (مفتاح، سجل) من أقسام الأرشيف التي تغطي الفترة.
+    الإجازة تُحفظ في كل شهر تغطيه أيامها، والاقتراح في شهر إرساله، فقد يتكرر نفس السجل في عدة أقسام.
+    إزالة التكرار والتصفية الدقيقة على المستدعي.
+    """
+    if archive is None:
+        return
+    for month in month_range(date_from, date_to):
+        for key, record in await asyncio.to_thread(archive.read, collection, month):
+            yield key, record
+
+def _archive_partitions(collection: str, record: dict) -> set:
+    """الأشهر (YYYY-MM) التي يُحفظ فيها السجل: كل شهر تغطيه الإجازة، فيجدها التصدير من أي شهر منها."""
+    if collection == "suggestions":
+        return {record.get("sent_at", "")[:7]}
+    leave_type_key = next(key for key, name in LEAVE_COLLECTIONS.items() if name == collection)
+    months = {d.strftime("%Y-%m") for d in leave_dates(leave_type_key, record)}
+    return months or {(record.get("start_date") or record.get("request_time", ""))[:7]}
+
+async def _archive_batch(collection: str, records: list) -> int:
+    """كتابة دفعة إلى أقسامها الشهرية ثم حذفها (مع فهرس الموظف) من المجموعات النشطة في كتابة واحدة."""
+    partitions = {}
+    for key, record in records:
+        for month in _archive_partitions(collection, record):
+            partitions.setdefault(month, []).append((key, record))
+    for month, items in partitions.items():
+        await asyncio.to_thread(archive.write, collection, month, items)
+    deletions = {f"{collection}/{key}": None for key, _ in records}
+    if collection != "suggestions":
+        deletions.update({f"employee_leaves/{record.get('employee_telegram_id')}/{key}": None
+                          for key, record in records if record.get("employee_telegram_id")})
+    await repo.update('/', deletions)
+    if collection == LEAVE_COLLECTIONS['fd']:
+        for key, _ in records:
+            coverage.remove(key)
+    metrics.inc("hr_bot_archived_records_total", (("collection", collection),), len(records))
+    return len(records)
+
+async def archive_old_records(cutoff: date) -> dict:
+    """
+    نقل الطلبات المغلقة التي انتهت قبل cutoff والاقتراحات المرسلة قبله إلى الأرشيف.
+    الإجازات تُقرأ شهراً بشهر عبر الفهرس start_date، والاقتراحات عبر نطاق مفاتيح push. يعيد العدد لكل مجموعة.
+    """
+    archived = {}
+    last_day = (cutoff - timedelta(days=1)).isoformat()
+    for leave_type_key, collection in LEAVE_COLLECTIONS.items():
+        archived[collection] = 0
+        oldest = await repo.query(f'/{collection}', order_by='start_date', start_at="0", limit_to_first=1)
+        if not oldest:
+            continue
+        first_start = date.fromisoformat(next(iter(oldest.values()))["start_date"])
+        for month in month_range(first_start, cutoff - timedelta(days=1)):
+            page = await repo.query(f'/{collection}', order_by='start_date', start_at=f"{month}-01",
+                                    end_at=min(f"{month}-31", last_day))
+            # الطلبات المعلقة أو التي تمتد إلى ما بعد الحد تبقى في المجموعة النشطة
+            records = [(key, record) for key, record in page.items()
+                       if record.get("status") != "pending"
+                       and (record.get("end_date") or record.get("start_date")) <= last_day]
+            if records:
+                archived[collection] += await _archive_batch(collection, records)
+    last_key = push_id_prefix(int(datetime.combine(cutoff, time.min).timestamp() * 1000))
+    archived["suggestions"] = 0
+    async for page in repo.scan('/suggestions', ARCHIVE_PAGE_SIZE, end_at=last_key):
+        archived["suggestions"] += await _archive_batch("suggestions", page)
+    return archived
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """مهمة دورية: أرشفة ما تجاوز نافذة الاحتفاظ ARCHIVE_RETENTION_DAYS."""
+    cutoff = date.today() - timedelta(days=ARCHIVE_RETENTION_DAYS)
+    archived = await archive_old_records(cutoff)
+    logger.info(f"Archived records older than {cutoff.isoformat()}: {archived}")
+
+# --- تصدير التقارير لمدير الموارد البشرية ---
+# يتم قراءة السجلات صفحةً صفحة وكتابتها مباشرة إلى ملف مؤقت، فلا تُحمّل المجموعات كاملة في الذاكرة.
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "500"))
+EXPORT_HEADERS = ["المعرف", "اسم الموظف", "معرف تيليجرام", "التفاصيل", "من تاريخ", "إلى تاريخ",
+                  "عدد الأيام", "السبب", "الحالة", "وقت الطلب", "نص الاقتراح"]
+EXPORT_STATUS_AR = {"pending": "قيد المراجعة", "approved": "مقبول", "rejected": "مرفوض"}
+EXPORT_SECTIONS_AR = {"full_day_leaves": "الإجازات اليومية", "hourly_leaves": "الأذونات الساعية",
+                      "suggestions": "الاقتراحات"}
+
+class CsvExportWriter:
+    """ملف CSV واحد لكل الأقسام، مع عمود يحدد القسم. الترميز utf-8-sig ليفتحه Excel بالعربية."""
+    extension = "csv"
+
+    def __init__(self, path: str):
+        self._file = open(path, "w", newline="", encoding="utf-8-sig")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(["القسم"] + EXPORT_HEADERS)
+        self._section = ""
+
+    def start_section(self, title: str) -> None:
+        self._section = title
+
+    def write(self, row: list) -> None:
+        self._writer.writerow([self._section] + row)
+
+    def close(self) -> None:
+        self._file.close()
+
+class XlsxExportWriter:
+    """ملف XLSX بورقة لكل قسم. وضع write_only يكتب الصفوف إلى القرص مباشرة بدلاً من الذاكرة."""
+    extension = "xlsx"
+
+    def __init__(self, path: str):
+        self._path = path
+        self._workbook = Workbook(write_only=True)
+        self._sheet = None
+
+    def start_section(self, title: str) -> None:
+        self._sheet = self._workbook.create_sheet(title=title)
+        self._sheet.append(EXPORT_HEADERS)
+
+    def write(self, row: list) -> None:
+        self._sheet.append(row)
 
-async def check_upcoming_leaves(context: ContextTypes.DEFAULT_TYPE):
+    def close(self) -> None:
+        self._workbook.save(self._path)
+
+def leave_export_row(leave_type_key: str, request_id: str, record: dict, dates: list) -> list:
+    return [
+        request_id,
+        record.get("employee_name", ""),
+        record.get("employee_telegram_id", ""),
+        leave_details_text(leave_type_key, record),
+        dates[0].isoformat() if dates else "",
+        dates[-1].isoformat() if dates else "",
+        len(dates) if leave_type_key == 'fd' else "",
+        record.get("reason", ""),
+        EXPORT_STATUS_AR.get(record.get("status"), record.get("status", "")),
+        record.get("request_time", ""),
+        "",
+    ]
+
+def suggestion_export_row(suggestion_id: str, record: dict) -> list:
+    return [suggestion_id, record.get("sender_name", ""), record.get("sender_id", ""), "", "", "", "", "", "",
+            record.get("sent_at", ""), record.get("message", "")]
+
+async def write_export(writer, date_from: date, date_to: date) -> int:
+    """
+    كتابة الإجازات التي تقع أي من أيامها ضمن الفترة، والاقتراحات المرسلة خلالها، من المجموعات النشطة
+    ثم من الأرشيف. يعيد عدد الصفوف.
     """
-    مهمة يومية للتحقق من الإجازات القادمة وإرسال تذكيرات.
-    تعمل هذه المهمة كل يوم في الساعة 9 مساءً.
+    rows = 0
+    # السجل قد يوجد في المكانين إذا فشل حذفه بعد أرشفته، لذلك لا يُكتب إلا مرة واحدة
+    written = set()
+    for leave_type_key, collection in LEAVE_COLLECTIONS.items():
+        writer.start_section(EXPORT_SECTIONS_AR[collection])
+        async for page in repo.scan(f'/{collection}', EXPORT_PAGE_SIZE):
+            for request_id, record in page:
+                dates = leave_dates(leave_type_key, record)
+                if any(date_from <= d <= date_to for d in dates):
+                    writer.write(leave_export_row(leave_type_key, request_id, record, dates))
+                    written.add(request_id)
+                    rows += 1
+        async for request_id, record in read_archive(collection, date_from, date_to):
+            dates = leave_dates(leave_type_key, record)
+            if request_id not in written and any(date_from <= d <= date_to for d in dates):
+                writer.write(leave_export_row(leave_type_key, request_id, record, dates))
+                written.add(request_id)
+                rows += 1
+    # مفاتيح الاقتراحات مرتبة زمنياً، لذلك نقرأ فقط نطاق المفاتيح الذي يغطي الفترة
+    writer.start_section(EXPORT_SECTIONS_AR["suggestions"])
+    first_key = push_id_prefix(int(datetime.combine(date_from, time.min).timestamp() * 1000))
+    last_key = push_id_prefix(int(datetime.combine(date_to + timedelta(days=1), time.min).timestamp() * 1000))
+    async for page in repo.scan('/suggestions', EXPORT_PAGE_SIZE, start_at=first_key, end_at=last_key):
+        for suggestion_id, record in page:
+            if date_from.isoformat() <= record.get("sent_at", "")[:10] <= date_to.isoformat():
+                writer.write(suggestion_export_row(suggestion_id, record))
+                written.add(suggestion_id)
+                rows += 1
+    async for suggestion_id, record in read_archive("suggestions", date_from, date_to):
+        if suggestion_id not in written and date_from.isoformat() <= record.get("sent_at", "")[:10] <= date_to.isoformat():
+            writer.write(suggestion_export_row(suggestion_id, record))
+            written.add(suggestion_id)
+            rows += 1
+    return rows
+
+def parse_export_args(args: list) -> tuple:
     """
-    logger.info("Running daily job: check_upcoming_leaves")
+    تحليل معاملات /export: [شهر YYYY-MM | من إلى] [csv|xlsx].
+    بدون تواريخ يتم تصدير الشهر الحالي. ترفع ValueError عند صيغة غير صحيحة.
+    """
+    args = list(args)
+    export_format = "csv"
+    if args and args[-1].lower() in ("csv", "xlsx"):
+        export_format = args.pop().lower()
     today = date.today()
-    tomorrow = today + timedelta(days=1)
-    
+    if not args:
+        month_start = today.replace(day=1)
+    elif len(args) == 1:
+        month_start = datetime.strptime(args[0], "%Y-%m").date()
+    elif len(args) == 2:
+        date_from, date_to = (datetime.strptime(arg, "%d/%m/%Y" if "/" in arg else "%Y-%m-%d").date() for arg in args)
+        if date_from > date_to:
+            raise ValueError("start date is after end date")
+        return date_from, date_to, export_format
+    else:
+        raise ValueError("too many arguments")
+    month_end = month_start.replace(day=calendar.monthrange(month_start.year, month_start.month)[1])
+    return month_start, month_end, export_format
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """أمر /export: تقرير بالإجازات والاقتراحات لفترة محددة كملف CSV أو XLSX، لمدير الموارد البشرية فقط."""
+    if not is_hr_user(update.effective_user.id):
+        await update.message.reply_text("هذا الأمر متاح لمدير الموارد البشرية فقط.")
+        return
+    try:
+        date_from, date_to, export_format = parse_export_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(
+            "صيغة غير صحيحة. أمثلة:\n/export\n/export 2024-08\n/export 2024-08-01 2024-08-15 xlsx")
+        return
+    if export_format == "xlsx" and Workbook is None:
+        await update.message.reply_text("تصدير XLSX غير متاح على هذا الخادم (مكتبة openpyxl غير مثبتة). يرجى استخدام csv.")
+        return
+
+    writer_class = XlsxExportWriter if export_format == "xlsx" else CsvExportWriter
+    status_message = await update.message.reply_text("⏳ جاري تجهيز التقرير...")
+    fd, path = tempfile.mkstemp(suffix=f".{writer_class.extension}")
+    os.close(fd)
+    try:
+        writer = writer_class(path)
+        try:
+            rows = await write_export(writer, date_from, date_to)
+        finally:
+            await asyncio.to_thread(writer.close)
+        filename = f"hr_report_{date_from.isoformat()}_{date_to.isoformat()}.{writer_class.extension}"
+        with open(path, "rb") as document:
+            await update.message.reply_document(
+                document=document, filename=filename,
+                caption=f"📊 تقرير الفترة من {date_from.strftime('%d/%m/%Y')} إلى {date_to.strftime('%d/%m/%Y')} ({rows} سجل)")
+        await status_message.delete()
+    except Exception as e:
+        logger.error(f"Failed to export report {date_from}..{date_to}: {e}")
+        await status_message.edit_text("حدث خطأ أثناء تجهيز التقرير. يرجى المحاولة لاحقًا.")
+    finally:
+        os.remove(path)
+
+# --- فهرس التغطية: من الغائب في كل يوم ---
+# فهرس في الذاكرة لكل يوم يحتوي الإجازات اليومية المقبولة، يُبنى عند الإقلاع ويُحدّث مع كل موافقة،
+# فيصبح سؤال "من الغائب في هذه الأيام؟" بحثاً مباشراً في قاموس بدلاً من قراءة كامل السجل.
+COVERAGE_MAX_NAMES = 20
+
+class CoverageIndex:
+    """فهرس {يوم: {معرف الطلب: (اسم الموظف، معرف الموظف)}} للإجازات اليومية المقبولة."""
+
+    def __init__(self):
+        self._by_day = {}
+        self._days_by_request = {}
+        self._leaves = {}
+        self.ready = False
+
+    def add(self, request_id: str, leave_request: dict) -> None:
+        """إضافة إجازة مقبولة (أو استبدالها إذا كانت موجودة)."""
+        self.remove(request_id)
+        dates = leave_dates('fd', leave_request)
+        entry = (leave_request.get("employee_name", "موظف"), str(leave_request.get("employee_telegram_id", "")))
+        for d in dates:
+            self._by_day.setdefault(d, {})[request_id] = entry
+        self._days_by_request[request_id] = dates
+        self._leaves[request_id] = leave_request
+
+    def remove(self, request_id: str) -> None:
+        self._leaves.pop(request_id, None)
+        for d in self._days_by_request.pop(request_id, []):
+            day = self._by_day.get(d)
+            if day is not None:
+                day.pop(request_id, None)
+                if not day:
+                    del self._by_day[d]
+
+    def absent_on(self, day: date) -> list:
+        """قائمة (الاسم، معرف الموظف) للغائبين في يوم محدد."""
+        return list(self._by_day.get(day, {}).values())
+
+    def leaves_on(self, day: date) -> dict:
+        """{معرف الطلب: السجل} للإجازات التي تغطي اليوم، بما فيها الممتدة التي بدأت قبله."""
+        return {request_id: self._leaves[request_id] for request_id in self._by_day.get(day, {})}
+
+    def leaves_from(self, first_day: date) -> dict:
+        """{معرف الطلب: السجل} للإجازات التي يقع أي من أيامها في first_day أو بعده."""
+        return {request_id: self._leaves[request_id] for request_id, dates in self._days_by_request.items()
+                if dates and max(dates) >= first_day}
+
+    def overlaps(self, dates: list, exclude_employee: str = None) -> dict:
+        """{اسم الموظف: [الأيام المشتركة]} للغائبين في أي من التواريخ المعطاة."""
+        by_employee = {}
+        for d in sorted(set(dates)):
+            for name, employee_id in self._by_day.get(d, {}).values():
+                if employee_id != exclude_employee:
+                    days = by_employee.setdefault(employee_id, (name, []))[1]
+                    if not days or days[-1] != d:
+                        days.append(d)
+        return dict(by_employee.values())
+
+    async def load(self) -> None:
+        """بناء الفهرس من جميع الإجازات اليومية المقبولة عبر الحقل المفهرس status_start."""
+        leaves = await repo.query('/full_day_leaves', order_by='status_start',
+                                  start_at="approved_", end_at="approved_\uf8ff")
+        self._by_day, self._days_by_request, self._leaves = {}, {}, {}
+        for request_id, leave_request in leaves.items():
+            self.add(request_id, leave_request)
+        self.ready = True
+        logger.info(f"Coverage index loaded: {len(self._days_by_request)} approved leaves, {len(self._by_day)} days")
+
+coverage = CoverageIndex()
+
+def format_overlaps(overlaps: dict) -> str:
+    """سطر لكل موظف غائب مع الأيام المشتركة (الأسماء مهرّبة لأن الرسالة تُرسل بصيغة Markdown)."""
+    lines = [f"• {escape_markdown(name)}: {', '.join(d.strftime('%d/%m') for d in days)}"
+             for name, days in list(overlaps.items())[:COVERAGE_MAX_NAMES]]
+    if len(overlaps) > COVERAGE_MAX_NAMES:
+        lines.append(f"• و{len(overlaps) - COVERAGE_MAX_NAMES} آخرون")
+    return "\n".join(lines)
+
+async def coverage_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """أمر /coverage [التاريخ]: الموظفون الذين لديهم إجازة يومية مقبولة في ذلك اليوم (اليوم الحالي افتراضياً)."""
+    user = get_predefined_user(str(update.effective_user.id))
+    if not user or user.get("role") not in ("hr", "team_leader"):
+        await update.message.reply_text("هذا الأمر متاح لمدير الموارد البشرية وقادة الفرق فقط.")
+        return
+    try:
+        arg = context.args[0] if context.args else None
+        day = datetime.strptime(arg, "%d/%m/%Y" if "/" in arg else "%Y-%m-%d").date() if arg else date.today()
+    except ValueError:
+        await update.message.reply_text("صيغة التاريخ غير صحيحة. مثال: /coverage 2024-08-01 أو /coverage 01/08/2024")
+        return
+    if not coverage.ready:
+        try:
+            await coverage.load()
+        except Exception as e:
+            logger.error(f"Failed to load coverage index: {e}")
+            await update.message.reply_text("حدث خطأ أثناء جلب بيانات الغياب. يرجى المحاولة لاحقًا.")
+            return
+    absent = coverage.absent_on(day)
+    if not absent:
+        await update.message.reply_text(f"✅ لا توجد إجازات مقبولة بتاريخ {day.strftime('%d/%m/%Y')}.")
+        return
+    names = "\n".join(f"• {name}" for name, _ in absent)
+    await update.message.reply_text(f"👥 الغائبون بتاريخ {day.strftime('%d/%m/%Y')} ({len(absent)}):\n{names}")
+
+# --- نسخة محلية من مجموعات الإجازات (مغذّاة بمستمع Firebase) ---
+# في وضع listen تُحمّل /full_day_leaves و/hourly_leaves مرة واحدة ثم تُطبّق أحداث put وpatch عليها تدريجياً،
+# مع فهارس ثانوية حسب الحالة وتاريخ البداية والموظف. القراءات التي تستخدمها ترجع إلى Firebase ما دامت غير جاهزة.
+# خيط المستمع ينتهي بصمت عند خطأ في اتصال SSE، لذلك تفحص مهمة دورية الخيوط وتعيد الاشتراك في المتوقف منها.
+LEAVE_REPLICA_MODE = os.getenv("LEAVE_REPLICA_MODE", "off") # off أو listen
+LEAVE_REPLICA_WATCH_INTERVAL = 30
+
+class LeaveReplica:
+    """نسخة {نوع الطلب: {معرف الطلب: السجل}} مع فهارس تُحدّث لكل طلب يتغير فقط."""
+
+    def __init__(self, mode: str = LEAVE_REPLICA_MODE):
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._records = {leave_type_key: {} for leave_type_key in LEAVE_COLLECTIONS}
+        self._by_status = {}
+        self._by_start = {}
+        self._by_employee = {}
+        self._indexed = {} # (النوع، المعرف) -> (الحالة، تاريخ البداية، الموظف)
+        self._written = {} # (النوع، المعرف) -> وقت الكتابة المحلية، لقياس تأخر النسخة
+        self._loaded = set()
+        self._listeners = {} # نوع الطلب -> تسجيل المستمع
+
+    @property
+    def ready(self) -> bool:
+        return len(self._loaded) == len(LEAVE_COLLECTIONS)
+
+    def _index_add(self, index: dict, value, key) -> None:
+        if value:
+            index.setdefault(value, set()).add(key)
+
+    def _index_remove(self, index: dict, value, key) -> None:
+        keys = index.get(value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    def _reindex(self, leave_type_key: str, request_id: str) -> None:
+        key = (leave_type_key, request_id)
+        old = self._indexed.pop(key, None)
+        if old is not None:
+            for index, value in zip((self._by_status, self._by_start, self._by_employee), old):
+                self._index_remove(index, value, key)
+        record = self._records[leave_type_key].get(request_id)
+        if not isinstance(record, dict):
+            self._records[leave_type_key].pop(request_id, None)
+            return
+        new = (record.get("status"), record.get("start_date"), str(record.get("employee_telegram_id", "")))
+        for index, value in zip((self._by_status, self._by_start, self._by_employee), new):
+            self._index_add(index, value, key)
+        self._indexed[key] = new
+
+    def _on_event(self, leave_type_key: str, event) -> None:
+        """تطبيق حدث المستمع على الطلبات التي يمسها فقط، ثم تحديث فهارسها."""
+        started = perf_counter()
+        try:
+            keys = [k for k in event.path.split('/') if k]
+            if event.event_type == 'put':
+                changes = [(keys, event.data)]
+            else:
+                # مفاتيح patch قد تكون مسارات متعددة المستويات عند الكتابة متعددة المسارات
+                changes = [(keys + [k for k in path.split('/') if k], value) for path, value in (event.data or {}).items()]
+            with self._lock:
+                records = self._records[leave_type_key]
+                touched = set()
+                for path, value in changes:
+                    if not path:
+                        # استبدال المجموعة كاملة (الحدث الأول من المستمع)
+                        touched.update(records)
+                        records.clear()
+                        records.update(value if isinstance(value, dict) else {})
+                        touched.update(records)
+                        continue
+                    _apply_firebase_event(records, 'put', '/'.join(path), value)
+                    touched.add(path[0])
+                for request_id in touched:
+                    self._reindex(leave_type_key, request_id)
+                    written_at = self._written.pop((leave_type_key, request_id), None)
+                    if written_at is not None:
+                        metrics.observe("hr_bot_replica_lag_seconds", (), monotonic() - written_at)
+                self._loaded.add(leave_type_key)
+                metrics.set_gauge("hr_bot_replica_records", (("collection", LEAVE_COLLECTIONS[leave_type_key]),),
+                                  len(records))
+            metrics.set_gauge("hr_bot_replica_last_event_timestamp_seconds", (), time_ns() / 1e9)
+        except Exception as e:
+            logger.error(f"Error applying {LEAVE_COLLECTIONS[leave_type_key]} replica event: {e}")
+        finally:
+            metrics.observe("hr_bot_replica_apply_seconds", (), perf_counter() - started)
+
+    def note_write(self, leave_type_key: str, request_id: str) -> None:
+        """تسجيل كتابة محلية؛ الزمن حتى وصول حدثها هو تأخر النسخة (hr_bot_replica_lag_seconds)."""
+        if self._listeners:
+            self._written[(leave_type_key, request_id)] = monotonic()
+
+    def get(self, leave_type_key: str, request_id: str):
+        with self._lock:
+            return self._records[leave_type_key].get(request_id)
+
+    def starting_from(self, first_day: date, status: str) -> dict:
+        """{نوع الطلب: {المعرف: السجل}} للطلبات بالحالة المحددة التي تبدأ في first_day أو بعده."""
+        first = first_day.isoformat()
+        result = {leave_type_key: {} for leave_type_key in LEAVE_COLLECTIONS}
+        with self._lock:
+            with_status = self._by_status.get(status, set())
+            for start, keys in self._by_start.items():
+                if start >= first:
+                    for leave_type_key, request_id in keys & with_status:
+                        result[leave_type_key][request_id] = self._records[leave_type_key][request_id]
+        return result
+
+    def employee_recent(self, employee_id: str, limit: int) -> list:
+        """آخر طلبات الموظف [(النوع، المعرف، السجل)] من الأقدم إلى الأحدث (المفاتيح مرتبة زمنياً)."""
+        with self._lock:
+            keys = sorted(self._by_employee.get(str(employee_id), set()), key=lambda key: key[1])[-limit:]
+            return [(leave_type_key, request_id, self._records[leave_type_key][request_id])
+                    for leave_type_key, request_id in keys]
+
+    def _subscribe(self, leave_type_key: str) -> None:
+        init_firebase()
+        self._listeners[leave_type_key] = db.reference(f'/{LEAVE_COLLECTIONS[leave_type_key]}').listen(
+            functools.partial(self._on_event, leave_type_key))
+
+    def start(self) -> None:
+        """تشغيل مستمع لكل مجموعة (عملية حاجبة). الحدث الأول يحمل المجموعة كاملة."""
+        if self.mode != 'listen' or self._listeners:
+            return
+        try:
+            for leave_type_key in LEAVE_COLLECTIONS:
+                self._subscribe(leave_type_key)
+        except Exception as e:
+            logger.error(f"Could not start leave replica listeners, reading from Firebase instead: {e}")
+            self.stop()
+
+    def check(self) -> None:
+        """
+        (عملية حاجبة) إذا توقف خيط مستمع تصبح المجموعة غير جاهزة فترجع القراءات إلى Firebase،
+        ثم يُعاد الاشتراك ويعيد الحدث الأول تحميلها كاملة.
+        """
+        if self.mode != 'listen':
+            return
+        for leave_type_key in LEAVE_COLLECTIONS:
+            listener = self._listeners.get(leave_type_key)
+            # ListenerRegistration لا يوفر واجهة عامة لحالة الاتصال، فنفحص خيطه مباشرة
+            thread = getattr(listener, "_thread", None)
+            if listener is not None and (thread is None or thread.is_alive()):
+                continue
+            if listener is not None:
+                logger.warning(f"{LEAVE_COLLECTIONS[leave_type_key]} replica listener stopped, re-subscribing")
+                metrics.inc("hr_bot_replica_resubscribes_total", (("collection", LEAVE_COLLECTIONS[leave_type_key]),))
+            with self._lock:
+                self._loaded.discard(leave_type_key)
+            self._listeners.pop(leave_type_key, None)
+            try:
+                self._subscribe(leave_type_key)
+            except Exception as e:
+                logger.error(f"Could not re-subscribe {LEAVE_COLLECTIONS[leave_type_key]} replica listener: {e}")
+
+    def stop(self) -> None:
+        for listener in self._listeners.values():
+            listener.close()
+        self._listeners = {}
+        self._loaded.clear()
+
+replica = LeaveReplica()
+
+async def watch_replica(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """مهمة دورية في كل عملية: إعادة تشغيل مستمعي النسخة المحلية المتوقفين."""
+    await asyncio.to_thread(replica.check)
+
+# --- قسم التذكيرات (جديد) ---
+# التذكير يُجدول لحظة الموافقة على الطلب بدلاً من مسح يومي لكل الإجازات.
+# REMINDER_DAYS_BEFORE=1 مع REMINDER_TIME=21:00 يعني مساء اليوم السابق، و0 مع 08:00 يعني صباح يوم الإجازة.
+REMINDER_TIME = os.getenv("REMINDER_TIME", "21:00")
+REMINDER_DAYS_BEFORE = int(os.getenv("REMINDER_DAYS_BEFORE", "1"))
+REMINDER_TIMEZONE = pytz.timezone(os.getenv("REMINDER_TIMEZONE", "Asia/Damascus"))
+
+def reminder_time_for(day: date) -> datetime:
+    """موعد إرسال تذكير الإجازات التي تبدأ في اليوم المحدد."""
+    hour, minute = (int(part) for part in REMINDER_TIME.split(":"))
+    return REMINDER_TIMEZONE.localize(datetime.combine(day - timedelta(days=REMINDER_DAYS_BEFORE), time(hour, minute)))
+
+def reminder_job_name(day: date) -> str:
+    return f"leave_reminder_{day.isoformat()}"
+
+def schedule_reminder(job_queue, leave_type_key: str, request_id: str, leave_request: dict) -> bool:
+    """
+    إضافة إجازة مقبولة إلى مهام تذكير كل يوم تغطيه (مهمة run_once واحدة لكل يوم تجمع كل إجازاته
+    حتى يبقى التذكير ملخصاً واحداً لكل مستلم). يعيد False إذا كانت مواعيد كل أيامها قد فاتت.
+    """
+    if leave_type_key == 'fd':
+        days = leave_dates('fd', leave_request)
+    else:
+        days = [date.fromisoformat(leave_request["start_date"])] if leave_request.get("start_date") else []
+    now = datetime.now(REMINDER_TIMEZONE)
+    scheduled = False
+    for day in days:
+        when = reminder_time_for(day)
+        if when <= now:
+            continue
+        jobs = job_queue.get_jobs_by_name(reminder_job_name(day))
+        if jobs:
+            leaves = jobs[0].data
+        else:
+            leaves = {"day": day, "fd": {}, "hourly": {}}
+            job_queue.run_once(instrument(leader_only(send_leave_reminders), "send_leave_reminders"), when,
+                               data=leaves, name=reminder_job_name(day))
+        leaves[leave_type_key][request_id] = leave_request
+        scheduled = True
+    return scheduled
+
+async def rehydrate_reminders(job_queue) -> int:
+    """
+    إعادة بناء مهام التذكير بعد الإقلاع من الإجازات المقبولة التي تبدأ من اليوم فصاعداً فقط،
+    عبر الفهرس status_start، والإجازات اليومية الجارية من فهرس التغطية.
+    مهام الأيام التي لم يعد لها إجازات تُحذف. يعيد عدد الإجازات المجدولة.
+    """
+    today = date.today()
+    if replica.ready:
+        upcoming = replica.starting_from(today, "approved")
+        fd_leaves, hourly_leaves = upcoming['fd'], upcoming['hourly']
+    else:
+        fd_leaves, hourly_leaves = await asyncio.gather(*(
+            repo.query(f'/{LEAVE_COLLECTIONS[leave_type_key]}', order_by='status_start',
+                       start_at=f"approved_{today.isoformat()}", end_at="approved_\uf8ff")
+            for leave_type_key in ('fd', 'hourly')))
+    if coverage.ready:
+        fd_leaves = {**fd_leaves, **coverage.leaves_from(today)}
+    for job in job_queue.jobs():
+        if job.name and job.name.startswith("leave_reminder_"):
+            job.schedule_removal()
+    scheduled = 0
+    for leave_type_key, leaves in (('fd', fd_leaves), ('hourly', hourly_leaves)):
+        for request_id, leave_request in leaves.items():
+            scheduled += schedule_reminder(job_queue, leave_type_key, request_id, leave_request)
+    logger.info(f"Scheduled reminders for {scheduled} upcoming approved leaves")
+    return scheduled
+
+def reminder_digest(day: date, full_day_leaves: dict, hourly_leaves: dict) -> list:
+    """ملخص واحد لإجازات وأذونات يوم معين مجمّع حسب النوع، مقسّماً حسب حد طول الرسالة."""
+    lines = [f"📢 **تذكير بإجازات وأذونات يوم {day.strftime('%d/%m/%Y')}** 📢"]
+    if full_day_leaves:
+        lines += ["", f"🗓️ **إجازات يومية في هذا اليوم ({len(full_day_leaves)}):**"]
+        lines += [
+            f"• **{escape_markdown(leave.get('employee_name', 'غير معروف'))}**: {leave_details_text('fd', leave)}"
+            for leave in sorted(full_day_leaves.values(), key=lambda leave: leave.get('employee_name', ''))
+        ]
+    if hourly_leaves:
+        lines += ["", f"🕒 **أذونات ساعية ({len(hourly_leaves)}):**"]
+        lines += [
+            f"• **{escape_markdown(leave.get('employee_name', 'غير معروف'))}**: "
+            f"{escape_markdown(leave.get('time_info', 'وقت غير محدد'))}"
+            for leave in sorted(hourly_leaves.values(), key=lambda leave: leave.get('employee_name', ''))
+        ]
+    return split_message(lines)
+
+async def send_leave_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """
+    مهمة run_once لكل يوم فيه إجازات مقبولة: ترسل لكل مستلم (مدير الموارد البشرية وقادة الفرق)
+    ملخصاً واحداً بإجازات ذلك اليوم من بيانات المهمة وفهرس التغطية، دون أي استعلام لقاعدة البيانات.
+    """
+    leaves = context.job.data
+    day = leaves["day"]
+    # فهرس التغطية يضيف الإجازات اليومية التي تغطي اليوم ولم تُجدول في هذه العملية
+    full_day_leaves = {**leaves["fd"], **coverage.leaves_on(day)}
+    logger.info(f"Running reminder job for {day.isoformat()}")
+
     # جلب قائمة المستلمين (مدير الموارد البشرية وقادة الفرق)
     recipient_ids = set(get_all_team_leaders_ids())
     hr_id = get_hr_telegram_id()
     if hr_id:
         recipient_ids.add(hr_id)
-        
+
     if not recipient_ids:
         logger.warning("No recipients (HR/Team Leaders) found for reminders.")
         return
+    if not full_day_leaves and not leaves["hourly"]:
+        return
 
-    # 1. التحقق من الإجازات اليومية
-    try:
-        full_day_leaves = db.reference('/full_day_leaves').get() or {}
-        for leave_id, leave_data in full_day_leaves.items():
-            if leave_data and leave_data.get("status") == "approved":
-                start_date = parse_start_date(leave_data.get("date_info", ""))
-                if start_date and start_date == tomorrow:
-                    employee_name = leave_data.get("employee_name", "غير معروف")
-                    date_info = leave_data.get("date_info", "")
-                    reminder_message = (
-                        f"📢 **تذكير بإجازة قادمة** 📢\n\n"
-                        f"نود تذكيركم بأن الموظف: **{employee_name}** سيكون في إجازة تبدأ غداً.\n\n"
-                        f"**التفاصيل:** {date_info}"
-                    )
-                    for chat_id in recipient_ids:
-                        try:
-                            await context.bot.send_message(chat_id=chat_id, text=reminder_message, parse_mode=ParseMode.MARKDOWN)
-                        except Exception as e:
-                            logger.error(f"Failed to send reminder to {chat_id}: {e}")
-    except Exception as e:
-        logger.error(f"Error checking full day leaves for reminders: {e}")
-
-    # 2. التحقق من الإجازات الساعية (الأذونات)
-    try:
-        hourly_leaves = db.reference('/hourly_leaves').get() or {}
-        for leave_id, leave_data in hourly_leaves.items():
-            if leave_data and leave_data.get("status") == "approved":
-                try:
-                    leave_date = datetime.strptime(leave_data.get("date", ""), "%d/%m/%Y").date()
-                    if leave_date == tomorrow:
-                        employee_name = leave_data.get("employee_name", "غير معروف")
-                        time_info = leave_data.get("time_info", "")
-                        date_str = leave_data.get("date", "")
-                        reminder_message = (
-                            f"📢 **تذكير بإذن قادم** 📢\n\n"
-                            f"نود تذكيركم بأن الموظف: **{employee_name}** لديه إذن غداً.\n\n"
-                            f"**التفاصيل:** {time_info} بتاريخ {date_str}"
-                        )
-                        for chat_id in recipient_ids:
-                            try:
-                                await context.bot.send_message(chat_id=chat_id, text=reminder_message, parse_mode=ParseMode.MARKDOWN)
-                            except Exception as e:
-                                logger.error(f"Failed to send reminder to {chat_id}: {e}")
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Could not parse date for hourly leave {leave_id}: {e}")
-    except Exception as e:
-        logger.error(f"Error checking hourly leaves for reminders: {e}")
+    # نفس الملخص لكل مستلم؛ أجزاؤه تُرسل بالترتيب لأن المرسل يحجز مواعيد كل محادثة بالتسلسل
+    digest = reminder_digest(day, full_day_leaves, leaves["hourly"])
+    messages = [
+        (chat_id, text, {"parse_mode": ParseMode.MARKDOWN})
+        for chat_id in recipient_ids
+        for text in digest
+    ]
+    report = await dispatcher.send_many(context.bot, messages)
+    failed = sum(1 for error in report.values() if error is not None)
+    logger.info(f"Reminder digests sent: {len(report) - failed} succeeded, {failed} failed "
+                f"({len(full_day_leaves)} full-day, {len(leaves['hourly'])} hourly)")
 
 # --- دوال الإلغاء والرجوع ---
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -951,26 +3113,971 @@ async def back_to_suggestion_entering(update: Update, context: ContextTypes.DEFA
     context.user_data.pop('suggestion_text', None)
     return SUGGESTION_ENTERING
 
+# --- الحفظ الدائم لحالة المحادثات وبيانات المستخدمين ---
+# يحفظ حالات ConversationHandler و context.user_data حتى لا تضيع الطلبات غير المكتملة عند إعادة التشغيل.
+# المكتبة تستدعي دوال update_* كل PERSISTENCE_FLUSH_INTERVAL ثانية فقط للبيانات التي تغيّرت،
+# ويتم تجميع تلك الاستدعاءات في عملية كتابة واحدة لكل دورة.
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND", "none")  # none أو sqlite أو firebase
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "bot_state.sqlite3")
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "5"))
+
+def _encode_state(value) -> str:
+    """تحويل القيمة إلى JSON مضغوط، مع تمثيل التواريخ بالشكل {"$d": "2024-08-01"}."""
+    def _default(obj):
+        if isinstance(obj, date):
+            return {"$d": obj.isoformat()}
+        raise TypeError(f"Object of type {type(obj).__name__} is not persistable")
+    return json.dumps(value, default=_default, separators=(",", ":"), ensure_ascii=False)
+
+def _decode_state(raw: str):
+    def _hook(obj):
+        if len(obj) == 1 and "$d" in obj:
+            return date.fromisoformat(obj["$d"])
+        return obj
+    return json.loads(raw, object_hook=_hook)
+
+def _conversation_key_to_str(key: tuple) -> str:
+    return ":".join(str(part) for part in key)
+
+def _conversation_key_from_str(raw: str) -> tuple:
+    return tuple(int(part) for part in raw.split(":"))
+
+class BufferedPersistence(BasePersistence):
+    """
+    أساس مشترك للواجهات الخلفية: يحفظ user_data وحالات المحادثات فقط،
+    ويجمع التغييرات في ذاكرة مؤقتة ثم يكتبها دفعة واحدة عبر _write_batch.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._pending_user_data = {}
+        self._pending_conversations = {}
+        self._flush_task = None
+
+    # --- دوال يجب أن تنفذها الواجهة الخلفية (حاجبة، تعمل خارج حلقة الأحداث) ---
+    def _load_user_data(self) -> dict:
+        raise NotImplementedError
+
+    def _load_conversations(self, name: str) -> dict:
+        raise NotImplementedError
+
+    def _write_batch(self, user_data: dict, conversations: dict) -> None:
+        raise NotImplementedError
+
+    # --- التجميع والكتابة ---
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self) -> None:
+        # انتظار قصير حتى تصل بقية استدعاءات update_* من نفس دورة الحفظ
+        await asyncio.sleep(0.1)
+        await self._write_pending()
+
+    async def _write_pending(self) -> None:
+        if not self._pending_user_data and not self._pending_conversations:
+            return
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        try:
+            await asyncio.to_thread(self._write_batch, user_data, conversations)
+        except Exception as e:
+            logger.error(f"Failed to write persistence batch: {e}")
+            # إعادة التغييرات إلى الذاكرة المؤقتة لمحاولة كتابتها في الدورة التالية
+            self._pending_user_data = {**user_data, **self._pending_user_data}
+            self._pending_conversations = {**conversations, **self._pending_conversations}
+
+    # --- واجهة BasePersistence ---
+    async def get_user_data(self) -> dict:
+        return await asyncio.to_thread(self._load_user_data)
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return await asyncio.to_thread(self._load_conversations, name)
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        self._pending_conversations[(name, _conversation_key_to_str(key))] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        # نسخة مسلسلة الآن، لأن القاموس الأصلي قد يتغير قبل الكتابة
+        self._pending_user_data[user_id] = _encode_state(data) if data else None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_user_data[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+
+class SQLitePersistence(BufferedPersistence):
+    """واجهة خلفية محلية في ملف SQLite (وضع WAL)، كل دورة حفظ هي معاملة واحدة."""
+
+    def __init__(self, path: str = PERSISTENCE_PATH, update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(update_interval=update_interval)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS conversations "
+                           "(name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, PRIMARY KEY (name, key))")
+        self._conn.commit()
+
+    def _load_user_data(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM user_data").fetchall()
+        return {user_id: _decode_state(data) for user_id, data in rows}
+
+    def _load_conversations(self, name: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {_conversation_key_from_str(key): json.loads(state) for key, state in rows}
+
+    def _write_batch(self, user_data: dict, conversations: dict) -> None:
+        with self._lock, self._conn:
+            for user_id, data in user_data.items():
+                if data is None:
+                    self._conn.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)", (user_id, data))
+            for (name, key), state in conversations.items():
+                if state is None:
+                    self._conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                       (name, key, json.dumps(state)))
+
+class FirebasePersistence(BufferedPersistence):
+    """
+    واجهة خلفية في Firebase تحت /bot_state. كل دورة حفظ هي تحديث واحد متعدد المسارات.
+    بيانات المستخدم تحفظ كنص JSON لأن مفاتيحها قد تحتوي رموزاً غير مسموحة في Firebase.
+    """
+
+    def __init__(self, root: str = "/bot_state", update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(update_interval=update_interval)
+        self._root = root
+
+    def _load_user_data(self) -> dict:
+        init_firebase()
+        stored = db.reference(f"{self._root}/user_data").get() or {}
+        return {int(user_id): _decode_state(data) for user_id, data in stored.items()}
+
+    def _load_conversations(self, name: str) -> dict:
+        init_firebase()
+        stored = db.reference(f"{self._root}/conversations/{name}").get() or {}
+        return {_conversation_key_from_str(key): state for key, state in stored.items()}
+
+    def _write_batch(self, user_data: dict, conversations: dict) -> None:
+        updates = {f"user_data/{user_id}": data for user_id, data in user_data.items()}
+        updates.update({f"conversations/{name}/{key}": state for (name, key), state in conversations.items()})
+        init_firebase()
+        db.reference(self._root).update(updates)
+
+def create_persistence():
+    """إنشاء واجهة الحفظ حسب PERSISTENCE_BACKEND، أو None لإبقاء الحالة في الذاكرة فقط."""
+    if PERSISTENCE_BACKEND == "sqlite":
+        return SQLitePersistence()
+    if PERSISTENCE_BACKEND == "firebase":
+        return FirebasePersistence()
+    return None
+
+# --- منع تكرار التحديثات والطلبات ---
+# تيليجرام يعيد إرسال التحديثات غير المؤكدة بعد إعادة التشغيل، والمستخدم قد يضغط الزر مرتين.
+# نحتفظ بمعرفات التحديثات ورموز الإرسال الأخيرة في ذاكرة LRU محدودة، مع نسخة دائمة تُحمّل عند الإقلاع،
+# فيكون الفحص في الذاكرة فقط ويتم إسقاط المكرر قبل أي كتابة إلى Firebase.
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "10000"))
+DEDUP_RETENTION = 2 * 24 * 3600 # تيليجرام يحتفظ بالتحديثات غير المستلمة 24 ساعة فقط
+DEDUP_PRUNE_INTERVAL = 3600
+
+class SQLiteIdempotencyStore:
+    """المعرفات المعالجة في نفس ملف SQLite المستخدم لحفظ الحالة."""
+
+    def __init__(self, path: str = PERSISTENCE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS idempotency "
+                           "(kind TEXT NOT NULL, key TEXT NOT NULL, seen_at REAL NOT NULL, PRIMARY KEY (kind, key))")
+        self._conn.commit()
+
+    def load_recent(self, kind: str, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM idempotency WHERE kind = ? ORDER BY seen_at DESC LIMIT ?",
+                                      (kind, limit)).fetchall()
+        return [key for key, in reversed(rows)]
+
+    def add(self, kind: str, keys: list, seen_at: float) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO idempotency (kind, key, seen_at) VALUES (?, ?, ?)",
+                                   [(kind, str(key), seen_at) for key in keys])
+
+    def remove(self, kind: str, key: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM idempotency WHERE kind = ? AND key = ?", (kind, str(key)))
+
+    def prune(self, before: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM idempotency WHERE seen_at < ?", (before,))
+
+class FirebaseIdempotencyStore:
+    """المعرفات المعالجة تحت /bot_state/idempotency/{kind}/{key} = وقت المعالجة (يحتاج ".indexOn": ".value")."""
+
+    def __init__(self, root: str = "/bot_state/idempotency"):
+        self._root = root
+
+    def load_recent(self, kind: str, limit: int) -> list:
+        init_firebase()
+        stored = db.reference(f"{self._root}/{kind}").order_by_value().limit_to_last(limit).get() or {}
+        return list(stored)
+
+    def add(self, kind: str, keys: list, seen_at: float) -> None:
+        init_firebase()
+        db.reference(f"{self._root}/{kind}").update({str(key): seen_at for key in keys})
+
+    def remove(self, kind: str, key: str) -> None:
+        init_firebase()
+        db.reference(f"{self._root}/{kind}/{key}").delete()
+
+    def prune(self, before: float) -> None:
+        init_firebase()
+        for kind in ("update", "submission"):
+            ref = db.reference(f"{self._root}/{kind}")
+            expired = ref.order_by_value().end_at(before).get() or {}
+            if expired:
+                ref.update({key: None for key in expired})
+
+def create_idempotency_store():
+    """نفس الواجهة الخلفية المختارة لحفظ الحالة، أو None للاكتفاء بالذاكرة."""
+    if PERSISTENCE_BACKEND == "sqlite":
+        return SQLiteIdempotencyStore()
+    if PERSISTENCE_BACKEND == "firebase":
+        return FirebaseIdempotencyStore()
+    return None
+
+class IdempotencyGuard:
+    """
+    ذاكرة LRU لمعرفات التحديثات ورموز الإرسال مع نسخة دائمة اختيارية.
+    معرفات التحديثات تُكتب دفعات كل 0.1 ثانية، أما رموز الإرسال فتُكتب قبل إنشاء الطلب.
+    """
+
+    def __init__(self, store=None, size: int = DEDUP_CACHE_SIZE):
+        self._store = store
+        self._size = size
+        self._seen = {"update": OrderedDict(), "submission": OrderedDict()}
+        self._pending_updates = []
+        self._flush_task = None
+        self._last_prune = 0.0
+
+    def attach(self, store) -> None:
+        """ربط النسخة الدائمة (تُنشأ عند بناء التطبيق وليس عند الاستيراد)."""
+        self._store = store
+
+    def _remember(self, kind: str, key) -> bool:
+        """إضافة المفتاح إلى الذاكرة. يعيد False إذا كان موجوداً من قبل."""
+        seen = self._seen[kind]
+        if key in seen:
+            seen.move_to_end(key)
+            return False
+        seen[key] = True
+        if len(seen) > self._size:
+            seen.popitem(last=False)
+        return True
+
+    async def load(self) -> None:
+        if self._store is None:
+            return
+        for kind in self._seen:
+            keys = await asyncio.to_thread(self._store.load_recent, kind, self._size)
+            for key in keys:
+                self._remember(kind, int(key) if kind == "update" else key)
+
+    def seen_update(self, update_id: int) -> bool:
+        """True إذا تمت معالجة هذا التحديث من قبل؛ وإلا يتم تسجيله."""
+        if not self._remember("update", update_id):
+            return True
+        if self._store is not None:
+            self._pending_updates.append(update_id)
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush_soon())
+        return False
+
+    async def _flush_soon(self) -> None:
+        await asyncio.sleep(0.1)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if self._store is None:
+            return
+        pending, self._pending_updates = self._pending_updates, []
+        now = time_ns() / 1e9
+        try:
+            if pending:
+                await asyncio.to_thread(self._store.add, "update", pending, now)
+            if now - self._last_prune > DEDUP_PRUNE_INTERVAL:
+                self._last_prune = now
+                await asyncio.to_thread(self._store.prune, now - DEDUP_RETENTION)
+        except Exception as e:
+            logger.error(f"Failed to persist processed update ids: {e}")
+
+    async def claim_submission(self, token: str) -> bool:
+        """حجز رمز إرسال قبل إنشاء الطلب. يعيد False إذا تم استخدام الرمز من قبل."""
+        if not self._remember("submission", token):
+            return False
+        if self._store is not None:
+            try:
+                await asyncio.to_thread(self._store.add, "submission", [token], time_ns() / 1e9)
+            except Exception as e:
+                # الحجز في الذاكرة يكفي لمنع الضغط المزدوج، والطلب نفسه قد يذهب إلى الطابور المحلي
+                logger.warning(f"Failed to persist submission token {token}, keeping it in memory only: {e}")
+        return True
+
+    async def release_submission(self, token: str) -> None:
+        """إلغاء الحجز عند فشل الحفظ، ليتمكن المستخدم من إعادة المحاولة."""
+        self._seen["submission"].pop(token, None)
+        if self._store is not None:
+            try:
+                await asyncio.to_thread(self._store.remove, "submission", token)
+            except Exception as e:
+                logger.warning(f"Failed to release submission token {token}: {e}")
+
+idempotency = IdempotencyGuard()
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """أول معالج لكل تحديث (المجموعة -1): إيقاف معالجة أي تحديث وصل من قبل."""
+    if idempotency.seen_update(update.update_id):
+        metrics.inc("hr_bot_duplicate_updates_total")
+        logger.info(f"Dropped duplicate update {update.update_id}")
+        raise ApplicationHandlerStop
+
+async def claim_submission(context: ContextTypes.DEFAULT_TYPE):
+    """
+    رمز الإرسال لهذه المحادثة (يُنشأ عند عرض ملخص التأكيد ويُستخدم كمعرف الطلب نفسه).
+    يعيد None إذا كان الطلب قد أُرسل من قبل.
+    """
+    token = context.user_data.get('submission_id') or generate_push_id()
+    if not await idempotency.claim_submission(token):
+        return None
+    return token
+
+# --- وضع Webhook (خادم HTTP غير متزامن مدمج) ---
+# BOT_MODE=webhook يستبدل الاستطلاع الطويل (polling) بخادم يستقبل التحديثات مباشرة من تيليجرام.
+# إذا كان WEBHOOK_URL فارغاً لا يتم تسجيل الـ webhook لدى تيليجرام، وهذا مفيد للاختبار المحلي
+# بإرسال تحديثات مسجلة (JSON) إلى العنوان عبر POST. الرمز السري إلزامي دائماً: إذا لم يُحدد WEBHOOK_SECRET
+# يتم توليد رمز عشوائي عند الإقلاع ويُسجّل مع الـ webhook، فلا يقبل الخادم تحديثات مزورة من أي جهة أخرى.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_IDLE_TIMEOUT = 75
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class HttpServer:
+    """
+    خادم HTTP/1.1 صغير مبني على asyncio بدون اعتماديات إضافية.
+    كل مسار يرتبط بدالة async تستقبل (headers, body) وتعيد (status, content_type, body).
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes = {}
+        self._server = None
+        self._connections = set()
+
+    def add_route(self, method: str, path: str, handler) -> None:
+        self._routes[(method, path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        """إيقاف استقبال الاتصالات الجديدة وإغلاق الاتصالات المفتوحة."""
+        if self._server is None:
+            return
+        self._server.close()
+        # الاتصالات المبقاة مفتوحة (keep-alive) يجب إغلاقها وإلا سينتظر wait_closed إلى الأبد
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, 400, "text/plain", b"bad request line", False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0") or 0)
+                if length > HTTP_MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"payload too large", False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+                path = target.split("?", 1)[0]
+                handler = self._routes.get((method, path))
+                if handler is None:
+                    status = 405 if any(p == path for _, p in self._routes) else 404
+                    await self._respond(writer, status, "text/plain", HTTP_REASONS[status].encode(), keep_alive)
+                    continue
+                try:
+                    status, content_type, payload = await handler(headers, body)
+                except Exception as e:
+                    logger.error(f"HTTP handler error on {method} {path}: {e}")
+                    status, content_type, payload = 500, "text/plain", b"internal error"
+                await self._respond(writer, status, content_type, payload, keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, content_type: str, payload: bytes, keep_alive: bool) -> None:
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+def add_webhook_routes(server: HttpServer, accept_update, is_ready) -> None:
+    """
+    تسجيل مسار استقبال التحديثات ومسار فحص الصحة على الخادم.
+    accept_update(data) دالة غير متزامنة تستلم التحديث كقاموس، و is_ready() تحدد إن كان البوت يقبل تحديثات.
+    """
+
+    async def receive_update(headers: dict, body: bytes):
+        # التحقق من الرمز السري الذي يرسله تيليجرام مع كل تحديث
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+            return 403, "text/plain", b"forbidden"
+        if not is_ready():
+            return 503, "text/plain", b"not running"
+        try:
+            payload = json.loads(body)
+            if not isinstance(payload, dict):
+                # JSON صالح لكنه ليس تحديثاً (مثل [] أو "x")؛ الرد 500 يجعل تيليجرام يعيد إرساله بلا نهاية
+                raise TypeError(f"update must be a JSON object, got {type(payload).__name__}")
+            await accept_update(payload)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return 400, "text/plain", b"malformed update"
+        return 200, "text/plain", b"ok"
+
+    async def health(headers: dict, body: bytes):
+        status = 200 if is_ready() else 503
+        return status, "application/json", json.dumps({"status": "ok" if status == 200 else "stopping"}).encode()
+
+    server.add_route("POST", WEBHOOK_PATH, receive_update)
+    server.add_route("GET", "/healthz", health)
+    if METRICS_MODE == "http":
+        server.add_route("GET", "/metrics", serve_metrics)
+
+async def run_webhook(application: Application) -> None:
+    """
+    تشغيل البوت في وضع Webhook مع إيقاف آمن عند SIGTERM/SIGINT:
+    يتوقف الخادم عن استقبال تحديثات جديدة، ثم تتم معالجة ما تبقى في الطابور قبل الإغلاق.
+    """
+    server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+
+    async def accept_update(data: dict) -> None:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    add_webhook_routes(server, accept_update, lambda: application.running)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        print(f"Bot is running in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+# --- وضع العمال المتعددين (توزيع التحديثات وانتخاب قائد للمهام) ---
+# عملية رئيسية واحدة تستقبل التحديثات (polling أو webhook) وتوزعها على BOT_WORKERS عملية حسب معرف المحادثة،
+# فتبقى كل محادثة في نفس العامل. حالة المحادثات مشتركة عبر واجهة الحفظ (sqlite أو firebase)،
+# والمهام المجدولة تعمل فقط في العامل الذي يملك عقد القيادة (lease) المسجل في نفس المخزن.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+COVERAGE_REFRESH_INTERVAL = float(os.getenv("COVERAGE_REFRESH_INTERVAL", "60"))
+DECISIONS_SYNC_OVERLAP = 60 * 1000 # هامش (مللي ثانية) لتأخر الكتابة واختلاف الساعات بين العمال
+WORKER_SHUTDOWN_TIMEOUT = 30
+WORKER_INDEX = None # رقم العامل داخل عملية العامل، و None في وضع العملية الواحدة
+
+def partition_for(update: Update, workers: int) -> int:
+    """رقم العامل المسؤول عن التحديث: حسب المحادثة، ثم المستخدم، ثم رقم التحديث."""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % workers
+
+class SQLiteLeaseStore:
+    """عقود القيادة في ملف SQLite مشترك بين العمليات على نفس الجهاز."""
+
+    def __init__(self, path: str = PERSISTENCE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS leases "
+                           "(name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._conn.commit()
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        """أخذ العقد أو تجديده إذا كان لنا أو منتهياً. يعيد True إذا أصبحنا القائد."""
+        now = time_ns() / 1e9
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now))
+            row = self._conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return bool(row and row[0] == holder)
+
+    def release(self, name: str, holder: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+class LeaseHeld(Exception):
+    """يُرفع داخل معاملة العقد لإلغائها عندما يملكه عامل آخر."""
+
+class FirebaseLeaseStore:
+    """عقود القيادة تحت /leases في Firebase لعمال على أجهزة مختلفة (يفترض تزامن الساعات تقريباً)."""
+
+    def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        now = time_ns() / 1e9
+
+        def _update(current):
+            if current and current.get("holder") != holder and current.get("expires_at", 0) > now:
+                raise LeaseHeld()
+            return {"holder": holder, "expires_at": now + ttl}
+        init_firebase()
+        try:
+            db.reference(f"/leases/{name}").transaction(_update)
+            return True
+        except LeaseHeld:
+            return False
+
+    def release(self, name: str, holder: str) -> None:
+        def _update(current):
+            if not current or current.get("holder") != holder:
+                raise LeaseHeld()
+            return None
+        init_firebase()
+        try:
+            db.reference(f"/leases/{name}").transaction(_update)
+        except LeaseHeld:
+            pass
+
+class JobLeader:
+    """يجدد عقد القيادة دورياً؛ المهام المغلفة بـ leader_only تعمل فقط عندما يكون is_leader صحيحاً."""
+
+    def __init__(self, store, name: str = "scheduled_jobs", ttl: float = LEASE_TTL):
+        self._store = store
+        self._name = name
+        self._ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+
+    async def renew(self, context: ContextTypes.DEFAULT_TYPE = None) -> None:
+        try:
+            leader = await asyncio.to_thread(self._store.acquire, self._name, self.holder, self._ttl)
+        except Exception as e:
+            # عند تعذر الوصول إلى المخزن نتنحى، لأن عاملاً آخر قد يأخذ العقد بعد انتهائه
+            logger.error(f"Failed to renew job lease: {e}")
+            leader = False
+        acquired = leader and not self.is_leader
+        if leader != self.is_leader:
+            logger.info(f"Worker {self.holder} {'acquired' if leader else 'lost'} the job lease")
+        self.is_leader = leader
+        metrics.set_gauge("hr_bot_job_leader", (), 1 if leader else 0)
+        if acquired and context is not None:
+            # مهام التذكير تُبنى فقط في العامل الذي يرسلها، مرة عند توليه القيادة
+            try:
+                await rehydrate_reminders(context.job_queue)
+            except Exception as e:
+                logger.error(f"Could not schedule upcoming leave reminders after acquiring the job lease: {e}")
+
+    async def release(self) -> None:
+        if self.is_leader:
+            self.is_leader = False
+            await asyncio.to_thread(self._store.release, self._name, self.holder)
+
+job_leader = None # يُنشأ فقط في وضع العمال المتعددين
+
+def leader_only(callback):
+    """تغليف مهمة مجدولة لتعمل في عامل واحد فقط عند تعدد العمال."""
+    @functools.wraps(callback)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE):
+        if job_leader is not None and not job_leader.is_leader:
+            return None
+        return await callback(context)
+    return wrapper
+
+async def sync_decisions(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    في وضع العمال المتعددين تتم الموافقات في عامل مدير الموارد البشرية، فيقرأ كل عامل القرارات الجديدة فقط
+    منذ آخر مزامنة (الحقل المفهرس decided_at) ويضيفها إلى فهرس التغطية، والعامل القائد إلى مهام التذكير.
+    """
+    synced_at = now_ms()
+    since = context.job.data.get("synced_at", synced_at) - DECISIONS_SYNC_OVERLAP
+    pages = await asyncio.gather(*(repo.query(f'/{collection}', order_by='decided_at', start_at=since)
+                                   for collection in LEAVE_COLLECTIONS.values()))
+    for leave_type_key, page in zip(LEAVE_COLLECTIONS, pages):
+        for request_id, leave_request in page.items():
+            if leave_request.get("status") != "approved":
+                continue
+            if leave_type_key == 'fd':
+                coverage.add(request_id, leave_request)
+            if job_leader.is_leader:
+                schedule_reminder(context.job_queue, leave_type_key, request_id, leave_request)
+    context.job.data["synced_at"] = synced_at
+
+def run_worker(index: int, updates_queue) -> None:
+    """نقطة دخول عملية العامل: تطبيق كامل بدون Updater يستقبل تحديثاته من العملية الرئيسية."""
+    # الإيقاف يتم عبر رسالة من العملية الرئيسية بعد أن تتوقف عن استقبال التحديثات
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    configure_logging()
+    global WORKER_INDEX, METRICS_PORT, job_leader
+    WORKER_INDEX = index
+    METRICS_PORT += index
+    job_leader = JobLeader(FirebaseLeaseStore() if PERSISTENCE_BACKEND == "firebase" else SQLiteLeaseStore())
+    asyncio.run(_run_worker(updates_queue))
+
+async def _run_worker(updates_queue) -> None:
+    application = build_application(default_builder().updater(None))
+    application.job_queue.run_repeating(job_leader.renew, interval=LEASE_TTL / 3, first=0)
+    # المزامنة الأولى تبدأ من لحظة الإقلاع، لأن post_init يحمّل فهرس التغطية كاملاً
+    application.job_queue.run_repeating(instrument(sync_decisions), interval=COVERAGE_REFRESH_INTERVAL,
+                                        first=COVERAGE_REFRESH_INTERVAL, data={"synced_at": now_ms()})
+    parent_pid = os.getppid()
+    loop = asyncio.get_running_loop()
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        logger.info(f"Worker {WORKER_INDEX} ({job_leader.holder}) started")
+        try:
+            while True:
+                try:
+                    data = await loop.run_in_executor(None, updates_queue.get, True, 1)
+                except queue.Empty:
+                    if os.getppid() != parent_pid:
+                        logger.error("Router process exited, stopping worker")
+                        break
+                    continue
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            await job_leader.release()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+class WorkerPool:
+    """العمليات العاملة وطوابيرها، مع إعادة تشغيل أي عامل يتوقف بشكل غير متوقع."""
+
+    def __init__(self, count: int):
+        self._context = multiprocessing.get_context("spawn")
+        self.queues = [self._context.Queue() for _ in range(count)]
+        self.processes = [None] * count
+
+    def _start(self, index: int) -> None:
+        process = self._context.Process(target=run_worker, args=(index, self.queues[index]), name=f"bot-worker-{index}")
+        process.start()
+        self.processes[index] = process
+
+    def start(self) -> None:
+        for index in range(len(self.queues)):
+            self._start(index)
+
+    def supervise(self) -> None:
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                # طابور جديد: العامل المتوقف قد يكون ترك قفل القراءة في الطابور القديم محجوزاً
+                self.queues[index] = self._context.Queue()
+                self._start(index)
+
+    def dispatch(self, update: Update) -> None:
+        self.queues[partition_for(update, len(self.queues))].put(update.to_dict())
+
+    def stop(self) -> None:
+        for updates_queue in self.queues:
+            updates_queue.put(None)
+        for process in self.processes:
+            process.join(WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                logger.error(f"Worker {process.name} did not stop in time, terminating")
+                process.terminate()
+
+async def _supervise_workers(pool: WorkerPool, stop_event: asyncio.Event) -> None:
+    while not stop_event.is_set():
+        pool.supervise()
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+
+async def _poll_updates(bot: Bot, pool: WorkerPool, stop_event: asyncio.Event) -> None:
+    """
+    حلقة getUpdates في العملية الرئيسية، توزع كل تحديث على عامله.
+    أخطاء تيليجرام (مثل Conflict أثناء تداخل نسختين عند النشر) يُعاد بعدها المحاولة بتأخير متزايد حتى 30 ثانية
+    كما في Application.run_polling، مع احترام مدة RetryAfter. الرمز غير الصالح فقط يوقف الحلقة.
+    """
+    await bot.delete_webhook()
+    offset = None
+    delay = 0.0
+    stop_task = asyncio.ensure_future(stop_event.wait())
+    try:
+        while not stop_event.is_set():
+            fetch = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES))
+            await asyncio.wait({fetch, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not fetch.done():
+                fetch.cancel()
+                break
+            try:
+                updates = fetch.result()
+            except InvalidToken:
+                raise
+            except TelegramError as e:
+                if isinstance(e, RetryAfter):
+                    wait = _retry_after_seconds(e)
+                elif isinstance(e, TimedOut):
+                    wait = 0.0
+                else:
+                    delay = min(30.0, 1.5 * delay or 1.0)
+                    wait = delay
+                logger.warning(f"getUpdates failed, retrying in {wait:.1f}s: {e}")
+                await asyncio.wait({stop_task}, timeout=wait)
+                continue
+            delay = 0.0
+            for update in updates:
+                pool.dispatch(update)
+                offset = update.update_id + 1
+    finally:
+        stop_task.cancel()
+
+async def run_router(pool: WorkerPool) -> None:
+    """العملية الرئيسية في وضع العمال المتعددين: استقبال التحديثات وتوزيعها ومراقبة العمال."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows
+
+    supervisor = asyncio.create_task(_supervise_workers(pool, stop_event))
+    async with Bot(TELEGRAM_TOKEN) as bot:
+        if BOT_MODE == "webhook":
+            server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+
+            async def accept_update(data: dict) -> None:
+                pool.dispatch(Update.de_json(data, bot))
+            add_webhook_routes(server, accept_update, lambda: not stop_event.is_set())
+            await server.start()
+            if WEBHOOK_URL:
+                await bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                                      secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+            print(f"Bot is running with {len(pool.queues)} workers in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            try:
+                await stop_event.wait()
+            finally:
+                await server.stop()
+        else:
+            print(f"Bot is running with {len(pool.queues)} workers in polling mode...")
+            await _poll_updates(bot, pool, stop_event)
+    await supervisor
+
+def run_workers(count: int) -> None:
+    """تشغيل العملية الرئيسية مع count عاملاً، ثم إيقاف العمال بعد معالجة ما وصلهم من تحديثات."""
+    if PERSISTENCE_BACKEND == "none":
+        # العمال يحتاجون مخزناً مشتركاً لحالة المحادثات وعقد القيادة؛ البيئة تنتقل إلى العمليات الفرعية
+        logger.warning("BOT_WORKERS > 1 requires shared state, using PERSISTENCE_BACKEND=sqlite")
+        os.environ["PERSISTENCE_BACKEND"] = "sqlite"
+    pool = WorkerPool(count)
+    pool.start()
+    try:
+        asyncio.run(run_router(pool))
+    finally:
+        pool.stop()
+
 async def post_init(application: Application) -> None:
-    """دالة يتم استدعاؤها بعد تهيئة البوت لوضع الأوامر الثابتة مثل /start."""
+    """
+    دالة يتم استدعاؤها بعد تهيئة البوت: الاتصال بـ Firebase وتحميل البيانات الأولية
+    ووضع الأوامر الثابتة مثل /start، مع تسجيل زمن كل خطوة.
+    """
+    started = monotonic()
+    try:
+        await asyncio.to_thread(init_firebase)
+    except Exception as e:
+        # لا نوقف البوت: ستتم إعادة المحاولة تلقائياً عند أول استخدام لقاعدة البيانات
+        logger.error(f"Could not connect to Firebase at startup, will retry lazily. Reason: {e}")
+    firebase_ready = monotonic()
+    # تحميل دليل المستخدمين مرة واحدة عند الإقلاع خارج حلقة الأحداث
+    await asyncio.to_thread(user_directory.start)
+    await asyncio.to_thread(replica.start)
+    users_ready = monotonic()
+    try:
+        await idempotency.load()
+    except Exception as e:
+        logger.error(f"Could not load processed update ids: {e}")
+    try:
+        await journal.load()
+    except Exception as e:
+        logger.error(f"Could not open the offline write queue: {e}")
+    try:
+        await coverage.load()
+    except Exception as e:
+        # سيُعاد التحميل عند أول استخدام لأمر /coverage
+        logger.error(f"Could not load coverage index at startup: {e}")
+    if job_leader is None:
+        # في وضع العمال يبنيها العامل القائد عند توليه القيادة (JobLeader.renew)
+        try:
+            await rehydrate_reminders(application.job_queue)
+        except Exception as e:
+            logger.error(f"Could not schedule upcoming leave reminders at startup: {e}")
     await application.bot.set_my_commands([
-        BotCommand("start", "العودة إلى القائمة الرئيسية")
+        BotCommand("start", "العودة إلى القائمة الرئيسية"),
+        BotCommand("my_leaves", "سجل طلباتي ورصيد الإجازات"),
     ])
+    await set_hr_commands(application.bot)
+    if METRICS_MODE == "http" and (BOT_MODE != "webhook" or WORKER_INDEX is not None):
+        # في وضع webhook يتم عرض /metrics على نفس الخادم، أما العمال فلكل منهم منفذ METRICS_PORT + رقمه
+        metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT)
+        metrics_server.add_route("GET", "/metrics", serve_metrics)
+        await metrics_server.start()
+        application.bot_data["metrics_server"] = metrics_server
+    logger.info(f"Startup timings: firebase={(firebase_ready - started) * 1000:.0f} ms, "
+                f"users={(users_ready - firebase_ready) * 1000:.0f} ms, total={(monotonic() - started) * 1000:.0f} ms")
 
-def main() -> None:
-    """الدالة الرئيسية لتشغيل البوت."""
-    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+async def post_shutdown(application: Application) -> None:
+    """دالة يتم استدعاؤها عند إيقاف البوت لإغلاق الموارد المفتوحة."""
+    metrics_server = application.bot_data.pop("metrics_server", None)
+    if metrics_server is not None:
+        await metrics_server.stop()
+    user_directory.stop()
+    replica.stop()
+    await idempotency.flush()
+    await outbox.flush()
+    journal.close()
+    repo.shutdown()
+
+def default_builder():
+    """منشئ التطبيق الافتراضي: الرمز وطبقة طلبات HTTP المقاسة."""
+    return (Application.builder().token(TELEGRAM_TOKEN)
+            .request(InstrumentedRequest(connection_pool_size=TELEGRAM_POOL_SIZE)))
+
+def build_application(builder=None) -> Application:
+    """بناء التطبيق مع جميع المعالجات والمهام المجدولة دون تشغيله."""
+    builder = builder or default_builder()
+    persistence = create_persistence()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    idempotency.attach(create_idempotency_store())
+    application = builder.post_init(post_init).post_shutdown(post_shutdown).build()
     
-    # --- جدولة مهمة التذكير اليومية (تعديل جديد) ---
+    # --- المهام المجدولة ---
+    # تذكيرات الإجازات تُجدول عند الموافقة وتُستعاد عند الإقلاع (انظر rehydrate_reminders)
     job_queue = application.job_queue
-    
-    # تحديد المنطقة الزمنية (سوريا، UTC+3)
-    syria_tz = pytz.timezone('Asia/Damascus')
-    
-    # جدولة المهمة لتعمل كل يوم الساعة 21:00 (9 مساءً) بتوقيت سوريا
-    # يجب أن يكون كائن الوقت مدركًا للمنطقة الزمنية
-    job_time = time(21, 0, 0, tzinfo=syria_tz)
-    job_queue.run_daily(check_upcoming_leaves, time=job_time)
+    # إعادة محاولة الإشعارات المؤجلة وإرسال ما بقي في صندوق الصادر بعد إعادة التشغيل
+    job_queue.run_repeating(instrument(leader_only(drain_outbox)), interval=OUTBOX_POLL_INTERVAL, first=1)
+    if archive is not None:
+        job_queue.run_repeating(instrument(leader_only(archive_job)), interval=ARCHIVE_INTERVAL, first=60)
+    # الطابور المحلي ملف على هذا الجهاز، لذلك تعمل إعادة تطبيقه في كل عملية وليس في القائد فقط
+    job_queue.run_repeating(instrument(replay_journal), interval=WAL_REPLAY_INTERVAL, first=1)
+    if replica.mode == 'listen':
+        job_queue.run_repeating(instrument(watch_replica), interval=LEAVE_REPLICA_WATCH_INTERVAL,
+                                first=LEAVE_REPLICA_WATCH_INTERVAL)
+    if METRICS_MODE == "log":
+        job_queue.run_repeating(log_metrics, interval=METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL)
     
     # --- معالج المحادثة الموحد ---
     # يحدد هذا المعالج تدفق المحادثة بالكامل وحالاتها المختلفة.
@@ -1039,16 +4146,51 @@ def main() -> None:
             CallbackQueryHandler(back_to_main_menu, pattern="^main_menu$"), # معالج زر القائمة الرئيسية العام
             CallbackQueryHandler(cancel_conversation, pattern="^cancel$") # معالج زر الإلغاء العام
         ],
-        allow_reentry=True # يسمح بإعادة دخول المحادثة من أي نقطة
+        allow_reentry=True, # يسمح بإعادة دخول المحادثة من أي نقطة
+        name="main_conversation",
+        persistent=persistence is not None, # حفظ حالة المحادثة عند تفعيل الحفظ الدائم
     )
 
     # إضافة المعالجات إلى التطبيق
+    # يعمل قبل جميع المعالجات لإسقاط التحديثات المكررة
+    application.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-1)
     application.add_handler(conv_handler)
     # معالج خاص لإجراءات مدير الموارد البشرية (الموافقة/الرفض)
     application.add_handler(CallbackQueryHandler(hr_action_handler, pattern="^(approve|reject)_(fd|hourly)_"))
+    application.add_handler(CommandHandler('pending', pending_command))
+    # التصدير قد يستغرق وقتاً مع السجلات الكبيرة، لذلك لا يعطّل معالجة باقي التحديثات
+    application.add_handler(CommandHandler('export', export_command, block=False))
+    application.add_handler(CommandHandler('coverage', coverage_command))
+    application.add_handler(CommandHandler('queue_status', queue_status_command))
+    application.add_handler(CallbackQueryHandler(pending_page_callback, pattern="^pending_(page|approve)_"))
+    # سجل طلبات الموظف ورصيده
+    application.add_handler(CommandHandler('my_leaves', my_leaves))
+    instrument_application(application)
+    return application
+
+def main() -> None:
+    """الدالة الرئيسية لتشغيل البوت."""
+    if BOT_WORKERS > 1:
+        run_workers(BOT_WORKERS)
+        return
+    application = build_application()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+        return
 
     print("Bot is running with Reminders and Suggestions Box feature...")
     application.run_polling() # بدء تشغيل البوت
 
 if __name__ == "__main__":
-    main()
+    configure_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate_leave_indexes()
+    elif len(sys.argv) > 1 and sys.argv[1] == "archive":
+        # أرشفة فورية لمرة واحدة: python HR_MYSLIDE.py archive
+        if archive is None:
+            print("ERROR: archiving is disabled (ARCHIVE_BACKEND=none).")
+        else:
+            print(asyncio.run(archive_old_records(date.today() - timedelta(days=ARCHIVE_RETENTION_DAYS))))
+            repo.shutdown()
+    else:
+        main()
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+"""
+أداة قياس أداء وتحميل للبوت بدون اتصال بالشبكة.
+
+تبني التطبيق الحقيقي عبر build_application() مع:
+- بوت وهمي يسجل استدعاءات Telegram API مع زمن استجابة قابل للتعديل.
+- بديل محلي في الذاكرة لـ firebase_admin.db يحصي عمليات القراءة والكتابة.
+ثم تعيد تشغيل آلاف المستخدمين الافتراضيين عبر مسارات الإجازة اليومية والإذن الساعي
+والاقتراحات، ثم موافقات مدير الموارد البشرية، وتطبع زمن المعالجة (p50/p95/p99)
+وعدد التحديثات في الثانية وعدد عمليات Firebase لكل مسار.
+
+الاستخدام:
+    python benchmark.py --users 1000 --concurrency 100 --telegram-latency 30 --db-latency 40
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+import types
+from collections import Counter, OrderedDict, defaultdict
+from datetime import date, timedelta
+
+
+# --- بديل Firebase في الذاكرة ---
+class InMemoryDatabase:
+    """شجرة JSON في الذاكرة تحاكي Realtime Database مع زمن استجابة وعدّاد عمليات."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.tree = {}
+        self.calls = Counter()
+        self._lock = threading.RLock()
+        self._push_ids = itertools.count(1)
+
+    def reference(self, path: str = '/'):
+        return InMemoryReference(self, [k for k in path.split('/') if k])
+
+    def _record(self, op: str) -> None:
+        with self._lock:
+            self.calls[op] += 1
+        if self.latency:
+            # العمليات الحقيقية حاجبة وتعمل على خيوط، لذلك المحاكاة حاجبة أيضاً
+            time.sleep(self.latency)
+
+    def _get(self, keys: list):
+        node = self.tree
+        for key in keys:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return copy.deepcopy(node)
+
+    def _set(self, keys: list, value) -> None:
+        if not keys:
+            self.tree = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+        node = self.tree
+        for key in keys[:-1]:
+            child = node.get(key)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[key] = {}
+            node = child
+        if value is None:
+            node.pop(keys[-1], None)
+        elif isinstance(value, dict) and ".sv" in value:
+            # قيم الخادم: يدعم فقط increment كما يستخدمه البوت
+            current = node.get(keys[-1])
+            node[keys[-1]] = (current if isinstance(current, (int, float)) else 0) + value[".sv"]["increment"]
+        else:
+            node[keys[-1]] = copy.deepcopy(value)
+
+
+class _Event:
+    def __init__(self, event_type: str, path: str, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class _Listener:
+    def close(self) -> None:
+        pass
+
+
+class InMemoryReference:
+    def __init__(self, database: InMemoryDatabase, keys: list):
+        self._db = database
+        self._keys = keys
+
+    @property
+    def key(self):
+        return self._keys[-1] if self._keys else None
+
+    def child(self, path: str):
+        return InMemoryReference(self._db, self._keys + [k for k in path.split('/') if k])
+
+    def get(self, etag: bool = False):
+        self._db._record('get')
+        with self._db._lock:
+            value = self._db._get(self._keys)
+        return (value, str(hash(json.dumps(value, sort_keys=True, default=str)))) if etag else value
+
+    def set(self, value) -> None:
+        self._db._record('set')
+        with self._db._lock:
+            self._db._set(self._keys, value)
+
+    def update(self, value: dict) -> None:
+        self._db._record('update')
+        with self._db._lock:
+            for path, child_value in value.items():
+                self._db._set(self._keys + [k for k in path.split('/') if k], child_value)
+
+    def delete(self) -> None:
+        self._db._record('delete')
+        with self._db._lock:
+            self._db._set(self._keys, None)
+
+    def push(self, value=''):
+        self._db._record('push')
+        key = f"-BENCH{next(self._db._push_ids):014d}"
+        with self._db._lock:
+            self._db._set(self._keys + [key], value)
+        return self.child(key)
+
+    def transaction(self, transaction_update):
+        self._db._record('transaction')
+        with self._db._lock:
+            new_value = transaction_update(self._db._get(self._keys))
+            self._db._set(self._keys, new_value)
+        return new_value
+
+    def listen(self, callback):
+        callback(_Event('put', '/', self.get()))
+        return _Listener()
+
+    def order_by_child(self, path: str):
+        return InMemoryQuery(self, lambda key, value: value.get(path) if isinstance(value, dict) else None)
+
+    def order_by_key(self):
+        return InMemoryQuery(self, lambda key, value: key)
+
+    def order_by_value(self):
+        return InMemoryQuery(self, lambda key, value: value)
+
+
+class InMemoryQuery:
+    def __init__(self, ref: InMemoryReference, sort_key):
+        self._ref = ref
+        self._sort_key = sort_key
+        self._filters = []
+        self._limit = None
+
+    def equal_to(self, value):
+        self._filters.append(lambda v: v == value)
+        return self
+
+    def start_at(self, value):
+        self._filters.append(lambda v: v >= value)
+        return self
+
+    def end_at(self, value):
+        self._filters.append(lambda v: v <= value)
+        return self
+
+    def limit_to_first(self, count: int):
+        self._limit = ('first', count)
+        return self
+
+    def limit_to_last(self, count: int):
+        self._limit = ('last', count)
+        return self
+
+    def get(self):
+        self._ref._db._record('query')
+        with self._ref._db._lock:
+            data = self._ref._db._get(self._ref._keys) or {}
+        items = []
+        for key, value in data.items():
+            sort_value = self._sort_key(key, value)
+            if sort_value is None or not all(check(sort_value) for check in self._filters):
+                continue
+            items.append((sort_value, key, value))
+        items.sort(key=lambda item: (str(type(item[0])), item[0], item[1]))
+        if self._limit:
+            kind, count = self._limit
+            items = items[:count] if kind == 'first' else items[-count:]
+        return OrderedDict((key, value) for _, key, value in items)
+
+
+def install_fake_firebase(database: InMemoryDatabase) -> None:
+    """تسجيل وحدة firebase_admin وهمية قبل استيراد البوت."""
+    firebase_admin = types.ModuleType('firebase_admin')
+    firebase_admin._apps = {}
+
+    def initialize_app(cred=None, options=None, name='[DEFAULT]'):
+        firebase_admin._apps[name] = object()
+        return firebase_admin._apps[name]
+
+    firebase_admin.initialize_app = initialize_app
+    credentials = types.ModuleType('firebase_admin.credentials')
+    credentials.Certificate = lambda *args, **kwargs: object()
+    db_module = types.ModuleType('firebase_admin.db')
+    db_module.reference = database.reference
+    firebase_admin.credentials = credentials
+    firebase_admin.db = db_module
+    sys.modules['firebase_admin'] = firebase_admin
+    sys.modules['firebase_admin.credentials'] = credentials
+    sys.modules['firebase_admin.db'] = db_module
+
+
+# --- بوت وهمي (طبقة طلبات HTTP لـ Telegram) ---
+def make_fake_request_class():
+    from telegram.request import BaseRequest
+
+    class RecordingRequest(BaseRequest):
+        """يحاكي Telegram Bot API: يسجل كل استدعاء ويعيد نتيجة صالحة بعد زمن استجابة ثابت."""
+
+        def __init__(self, latency: float, calls: Counter):
+            self.latency = latency
+            self.calls = calls
+            self._message_ids = itertools.count(1000)
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit('/', 1)[-1]
+            self.calls[api_method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            params = request_data.parameters if request_data else {}
+            if api_method == 'getMe':
+                result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif api_method in ('sendMessage', 'editMessageText', 'sendDocument'):
+                chat_id = params.get("chat_id", 1)
+                try:
+                    chat_id = int(chat_id)
+                except (TypeError, ValueError):
+                    chat_id = 1
+                result = {"message_id": next(self._message_ids), "date": int(time.time()),
+                          "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return RecordingRequest
+
+
+# --- توليد التحديثات الافتراضية ---
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        return {"message_id": next(self._message_ids), "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text}
+
+    def text(self, user_id: int, text: str) -> dict:
+        message = self._message(user_id, text)
+        if text.startswith('/'):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        message = self._message(user_id, "رسالة سابقة")
+        message["from"] = {"id": 1, "is_bot": True, "first_name": "Bench"}
+        return {"update_id": next(self._update_ids),
+                "callback_query": {"id": str(next(self._update_ids)), "from": self._user(user_id),
+                                   "chat_instance": str(user_id), "data": data, "message": message}}
+
+
+def full_day_flow(factory: UpdateFactory, user_id: int) -> list:
+    day = date.today() + timedelta(days=1 + user_id % 20)
+    return [
+        ("start", factory.text(user_id, "/start")),
+        ("req_daily", factory.callback(user_id, "req_daily")),
+        ("fd_name", factory.text(user_id, f"موظف {user_id}")),
+        ("fd_reason", factory.text(user_id, "سبب شخصي")),
+        ("fd_duration", factory.callback(user_id, "duration_single")),
+        ("fd_calendar", factory.callback(user_id, f"CAL_DAY_{day.year}_{day.month}_{day.day}")),
+        ("fd_confirm", factory.callback(user_id, "confirm_send")),
+    ]
+
+
+def hourly_flow(factory: UpdateFactory, user_id: int) -> list:
+    day = date.today() + timedelta(days=user_id % 7)
+    return [
+        ("start", factory.text(user_id, "/start")),
+        ("req_hourly", factory.callback(user_id, "req_hourly")),
+        ("hl_type", factory.callback(user_id, "hourly_late")),
+        ("hl_date", factory.callback(user_id, f"HL_DATE_{day.isoformat()}")),
+        ("hl_time", factory.callback(user_id, "TIME_10:00 AM")),
+        ("hl_name", factory.text(user_id, f"موظف {user_id}")),
+        ("hl_reason", factory.text(user_id, "موعد طبي")),
+        ("hl_confirm", factory.callback(user_id, "confirm_send")),
+    ]
+
+
+def suggestion_flow(factory: UpdateFactory, user_id: int) -> list:
+    return [
+        ("start", factory.text(user_id, "/start")),
+        ("req_suggestion", factory.callback(user_id, "req_suggestion")),
+        ("sugg_text", factory.text(user_id, "اقتراح لتحسين بيئة العمل")),
+        ("sugg_confirm", factory.callback(user_id, "sugg_anonymous")),
+    ]
+
+
+# --- التشغيل والقياس ---
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_phase(application, name: str, flows: list, concurrency: int, database: InMemoryDatabase,
+                    telegram_calls: Counter) -> dict:
+    """تشغيل مجموعة من المسارات (مسار لكل مستخدم) بشكل متزامن وقياس زمن كل تحديث."""
+    from telegram import Update
+
+    latencies = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+    db_before, tg_before = Counter(database.calls), Counter(telegram_calls)
+
+    async def run_user(steps: list) -> None:
+        async with semaphore:
+            for step, raw_update in steps:
+                update = Update.de_json(raw_update, application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[step].append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(steps) for steps in flows))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(steps) for steps in flows)
+    return {
+        "name": name,
+        "flows": len(flows),
+        "updates": updates,
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "db_calls": database.calls - db_before,
+        "telegram_calls": telegram_calls - tg_before,
+    }
+
+
+def print_report(result: dict) -> None:
+    flows = max(result["flows"], 1)
+    all_latencies = [value for values in result["latencies"].values() for value in values]
+    print(f"\n=== {result['name']} ({result['flows']} flows, {result['updates']} updates, {result['elapsed']:.2f}s) ===")
+    print(f"throughput: {result['updates'] / result['elapsed']:.1f} updates/s")
+    print(f"{'step':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, values in list(result["latencies"].items()) + [("ALL", all_latencies)]:
+        print(f"{step:<16}{len(values):>8}{percentile(values, 0.50):>10.1f}"
+              f"{percentile(values, 0.95):>10.1f}{percentile(values, 0.99):>10.1f}")
+    db_calls = ", ".join(f"{op}={count / flows:.2f}" for op, count in sorted(result["db_calls"].items())) or "none"
+    tg_calls = ", ".join(f"{op}={count / flows:.2f}" for op, count in sorted(result["telegram_calls"].items())) or "none"
+    print(f"firebase calls per flow: {db_calls}")
+    print(f"telegram calls per flow: {tg_calls}")
+
+
+def seed_users(database: InMemoryDatabase, employees: int, leaders: int) -> tuple:
+    hr_id = 10
+    users = {"hr": {"telegram_id": str(hr_id), "role": "hr", "name": "HR"}}
+    for i in range(leaders):
+        users[f"leader{i}"] = {"telegram_id": str(100 + i), "role": "team_leader", "name": f"Leader {i}"}
+    database.tree["users"] = users
+    employee_ids = [100000 + i for i in range(employees)]
+    return hr_id, employee_ids
+
+
+async def main_async(args) -> None:
+    database = InMemoryDatabase(latency=args.db_latency / 1000)
+    install_fake_firebase(database)
+    hr_id, employee_ids = seed_users(database, args.users, args.leaders)
+
+    import HR_MYSLIDE
+    from telegram.ext import Application
+
+    # سجلات INFO لكل طلب تشوّه القياس
+    logging.getLogger().setLevel(logging.WARNING)
+    if not args.rate_limits:
+        # قياس قدرة البوت نفسه: حدود تيليجرام لكل محادثة تجعل إشعارات القادة تمتد لدقائق
+        HR_MYSLIDE.dispatcher = HR_MYSLIDE.NotificationDispatcher(rate=1e6, per_chat_interval=0)
+
+    telegram_calls = Counter()
+    RecordingRequest = make_fake_request_class()
+    builder = (Application.builder().token("123456:BENCHMARK")
+               .request(RecordingRequest(args.telegram_latency / 1000, telegram_calls))
+               .get_updates_request(RecordingRequest(args.telegram_latency / 1000, telegram_calls)))
+    application = HR_MYSLIDE.build_application(builder)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    factory = UpdateFactory()
+    thirds = max(1, len(employee_ids) // 3)
+    phases = {
+        "full_day": [full_day_flow(factory, uid) for uid in employee_ids[:thirds]],
+        "hourly": [hourly_flow(factory, uid) for uid in employee_ids[thirds:2 * thirds]],
+        "suggestion": [suggestion_flow(factory, uid) for uid in employee_ids[2 * thirds:]],
+    }
+    results = []
+    for name in args.flows:
+        if name == "approval":
+            continue
+        results.append(await run_phase(application, name, phases[name], args.concurrency, database, telegram_calls))
+
+    if "approval" in args.flows:
+        approvals = []
+        for collection, key in (("full_day_leaves", "fd"), ("hourly_leaves", "hourly")):
+            for leave_id in (database.tree.get(collection) or {}):
+                approvals.append([("hr_approve", factory.callback(hr_id, f"approve_{key}_{leave_id}"))])
+        results.append(await run_phase(application, "approval", approvals, args.concurrency, database, telegram_calls))
+
+    # إيقاف التطبيق ينتظر المهام الخلفية (مثل إشعارات قادة الفرق) قبل طباعة التقرير
+    await application.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    await application.shutdown()
+
+    for result in results:
+        print_report(result)
+    print(f"\nTotal Telegram API calls: {sum(telegram_calls.values())} {dict(telegram_calls)}")
+    print(f"Total Firebase calls: {sum(database.calls.values())} {dict(database.calls)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the HR bot.")
+    parser.add_argument("--users", type=int, default=900, help="synthetic employees, split across the three flows")
+    parser.add_argument("--leaders", type=int, default=5, help="team leaders notified on approval")
+    parser.add_argument("--concurrency", type=int, default=100, help="users in flight at the same time")
+    parser.add_argument("--telegram-latency", type=float, default=30.0, help="fake Telegram API latency (ms)")
+    parser.add_argument("--db-latency", type=float, default=40.0, help="fake Firebase latency (ms)")
+    parser.add_argument("--rate-limits", action="store_true", help="keep Telegram's per-chat/global send limits")
+    parser.add_argument("--flows", nargs="+", default=["full_day", "hourly", "suggestion", "approval"],
+                        choices=["full_day", "hourly", "suggestion", "approval"])
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()